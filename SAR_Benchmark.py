@@ -0,0 +1,320 @@
+import argparse
+import os
+import random
+import re
+import tempfile
+import time
+from typing import List
+
+from SAR_lib import SAR_Indexer, SAR_Posting, SAR_Tokenizer, SAR_Permuterm, SAR_Kgram, parse_query
+
+
+def read_articles(root:str):
+    """
+    Devuelve todas las lineas (articulos) de los ficheros json de "root".
+    """
+    if os.path.isfile(root):
+        filenames = [root]
+    else:
+        filenames = sorted(os.path.join(d, filename) for d, _, files in os.walk(root)
+                           for filename in files if filename.endswith('.json'))
+    lines = []
+    for filename in filenames:
+        with open(filename) as fh:
+            lines.extend(line for line in fh if line.strip())
+    return lines
+
+
+def bench_indexing(args):
+    """
+    Indexa los primeros n articulos para tamaños crecientes y muestra el tiempo por articulo,
+    que debe mantenerse constante si la indexacion es lineal.
+    """
+    lines = read_articles(args.dir)
+    sizes = args.sizes or [len(lines) // 2**k for k in range(4, -1, -1)]
+    print("%10s %10s %14s %8s" % ('articles', 'time (s)', 'us/article', 'ratio'))
+    first = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            filename = os.path.join(tmp, 'bench.json')
+            with open(filename, 'w') as fh:
+                fh.writelines(lines[:n])
+            indexer = SAR_Indexer()
+            t0 = time.perf_counter()
+            indexer.index_dir(filename, multifield=args.multifield, positional=False, stem=False, permuterm=False)
+            elapsed = time.perf_counter() - t0
+            per_article = elapsed / max(n, 1) * 1e6
+            first = first or per_article
+            print("%10d %10.2f %14.1f %8.2f" % (n, elapsed, per_article, per_article / first))
+
+
+def article_texts(indexer:SAR_Indexer, line:str) -> List[str]:
+    """
+    Devuelve los textos de un articulo en el orden en el que se tokenizan al indexar.
+    """
+    article = indexer.parse_articles(line)
+    texts = [article['title'], article['summary']]
+    for sec in article['sections']:
+        for subsec in [sec] + sec['subsections']:
+            texts.append(subsec['name'])
+            texts.append(subsec['text'])
+    return texts
+
+
+def bench_tokenizer(args):
+    """
+    Compara los tokens por segundo de cada backend de SAR_Tokenizer sobre los textos de un crawl
+    llamando al tokenizador por texto, con el generador, por lotes de un articulo y por lotes
+    de varios articulos. Comprueba tambien que todos los backends devuelven los mismos tokens.
+    """
+    lines = read_articles(args.dir)[:args.articles]
+    articles = [article_texts(SAR_Indexer(), line) for line in lines]
+    batches = [sum(articles[i:i + args.batch], []) for i in range(0, len(articles), args.batch)]
+    reference = None
+    print("%-10s %-16s %12s %14s" % ('backend', 'mode', 'tokens', 'tokens/s'))
+    for backend in SAR_Tokenizer.BACKENDS:
+        tokenizer = SAR_Tokenizer(backend)
+        modes = [
+            ('tokenize', lambda: [tokenizer.tokenize(text) for texts in articles for text in texts]),
+            ('iter_tokens', lambda: [list(tokenizer.iter_tokens(text)) for texts in articles for text in texts]),
+            ('batch/article', lambda: [tokens for texts in articles for tokens in tokenizer.tokenize_batch(texts)]),
+            ('batch/%d' % args.batch, lambda: [tokens for texts in batches for tokens in tokenizer.tokenize_batch(texts)]),
+        ]
+        for mode, run in modes:
+            t0 = time.perf_counter()
+            result = run()
+            elapsed = time.perf_counter() - t0
+            if reference is None:
+                reference = result
+            elif result != reference:
+                print("ERROR: backend '{}' ({}) returns different tokens".format(backend, mode))
+            ntokens = sum(len(tokens) for tokens in result)
+            print("%-10s %-16s %12d %14.0f" % (backend, mode, ntokens, ntokens / elapsed))
+
+
+def wildcard_patterns(vocabulary:List[str], n:int, seed:int=0) -> List[str]:
+    """
+    Genera "n" consultas con comodines a partir de terminos del vocabulario:
+    prefijos, sufijos, comodines en medio y comodines de un caracter.
+    """
+    rnd = random.Random(seed)
+    patterns = []
+    for i in range(n):
+        term = rnd.choice(vocabulary)
+        half = max(1, len(term) // 2)
+        kind = i % 4
+        if kind == 0:
+            patterns.append(term[:half] + '*')
+        elif kind == 1:
+            patterns.append('*' + term[half:])
+        elif kind == 2:
+            patterns.append(term[:1] + '*' + term[-1:])
+        else:
+            patterns.append(term[:-1] + '?')
+    return patterns
+
+
+def bench_wildcard(args):
+    """
+    Compara el indice permuterm y el de k-gramas de cada campo de un indice guardado: tiempo
+    de construccion, memoria y latencia de las busquedas con comodines, junto a recorrer el
+    vocabulario con una expresion regular.
+    """
+    indexer = SAR_Indexer()
+    indexer.load_info(args.index)
+    print("%-14s %-10s %10s %12s %10s %10s %12s" % ('field', 'engine', 'terms', 'entries', 'build (s)', 'MB', 'us/query'))
+    for field, terms in indexer.index.items():
+        vocabulary = list(terms)
+        if not vocabulary:
+            continue
+        patterns = wildcard_patterns(vocabulary, args.queries)
+        regexes = {pattern: re.compile(re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.')) for pattern in patterns}
+        engines = []
+        for name, engine in [('permuterm', SAR_Permuterm), ('kgram', SAR_Kgram)]:
+            t0 = time.perf_counter()
+            built = engine(vocabulary)
+            engines.append((name, built.lookup, len(built), time.perf_counter() - t0, built.nbytes()))
+        engines.append(('scan', lambda pattern: [term for term in vocabulary if regexes[pattern].fullmatch(term)], 0, 0, 0))
+        reference = None
+        for name, lookup, entries, build, nbytes in engines:
+            t0 = time.perf_counter()
+            result = [sorted(lookup(pattern)) for pattern in patterns]
+            elapsed = time.perf_counter() - t0
+            if reference is None:
+                reference = result
+            elif result != reference:
+                print("ERROR: engine '{}' returns different terms".format(name))
+            print("%-14s %-10s %10d %12d %10.2f %10.2f %12.1f" % (field, name, len(vocabulary), entries, build,
+                                                                 nbytes / 2**20, elapsed / len(patterns) * 1e6))
+
+
+def read_queries(filename:str) -> List[str]:
+    """
+    Devuelve las consultas de un fichero de -L (una por linea) o de -T (consulta y resultado
+    separados por un tabulador, las lineas que empiezan por '#' son comentarios).
+    """
+    with open(filename, encoding='utf-8') as fh:
+        lines = fh.read().strip().split('\n')
+    return [line.split('\t')[0] for line in lines if line and line[0] != '#']
+
+
+def bench_queries(args):
+    """
+    Mide el tiempo de compilar las consultas de un fichero y el de resolverlas sin la cache
+    de consultas compiladas (se compilan cada vez) y con ella, las dos sin cache de resultados.
+    Por ultimo mide una pasada por el fichero con la cache de resultados, que empieza vacia.
+    """
+    indexer = SAR_Indexer()
+    indexer.load_info(args.index)
+    indexer.load_sections()
+    indexer.set_cache(0)
+    queries = read_queries(args.qlist)
+    fields = dict(indexer.fields)
+    t0 = time.perf_counter()
+    for _ in range(args.repeats):
+        for query in queries:
+            parse_query(query, fields)
+    compile_time = (time.perf_counter() - t0) / args.repeats
+    for query in queries: # primera pasada para cargar las posting lists en memoria
+        indexer.solve_query(query)
+    print("%-10s %12s" % ('mode', 'us/query'))
+    print("%-10s %12.1f" % ('compile', compile_time / len(queries) * 1e6))
+    for mode in ['cold', 'cached']:
+        t0 = time.perf_counter()
+        for _ in range(args.repeats):
+            for query in queries:
+                if mode == 'cold':
+                    indexer.plan_cache.clear()
+                indexer.solve_query(query)
+        elapsed = (time.perf_counter() - t0) / args.repeats
+        print("%-10s %12.1f" % (mode, elapsed / len(queries) * 1e6))
+    indexer.set_cache(SAR_Indexer.RESULT_CACHE_MB)
+    t0 = time.perf_counter()
+    for query in queries:
+        indexer.solve_query(query)
+    elapsed = time.perf_counter() - t0
+    lookups = indexer.cache_hits + indexer.cache_misses
+    print("%-10s %12.1f   (%.1f%% hits)" % ('results', elapsed / len(queries) * 1e6,
+                                          100 * indexer.cache_hits / lookups if lookups else 0))
+
+
+def bench_intersection(args):
+    """
+    Compara and_posting() y minus_posting() recorriendo las dos posting lists (GALLOP_RATIO
+    infinito) y con busqueda binaria en la larga, para relaciones de tamaño crecientes entre
+    una posting list corta aleatoria y una larga de "args.size" articulos.
+    Los mapas de bits no se usan (BITMAP_RATIO = 0), asi se comparan siempre las dos mezclas.
+    """
+    rnd = random.Random(0)
+    universe = 2 * args.size
+    large = SAR_Posting(sorted(rnd.sample(range(universe), args.size)))
+    indexer = SAR_Indexer()
+    indexer.artid = universe # numero de articulos del indice, los artid son menores
+    indexer.BITMAP_RATIO = 0
+    print("%10s %10s %-8s %14s %14s %8s" % ('short', 'ratio', 'op', 'linear (ms)', 'gallop (ms)', 'speedup'))
+    for ratio in args.ratios:
+        small = SAR_Posting(sorted(rnd.sample(range(universe), max(1, args.size // ratio))))
+        operations = [('and', indexer.and_posting, small, large), ('minus', indexer.minus_posting, small, large),
+                      ('minus/r', indexer.minus_posting, large, small)]
+        for name, operation, p1, p2 in operations:
+            times = []
+            results = []
+            for gallop_ratio in [float('inf'), SAR_Indexer.GALLOP_RATIO]:
+                indexer.GALLOP_RATIO = gallop_ratio
+                t0 = time.perf_counter()
+                results.append(operation(p1, p2))
+                times.append(time.perf_counter() - t0)
+            if results[0] != results[1]:
+                print("ERROR: '{}' returns different postings".format(name))
+            print("%10d %10d %-8s %14.2f %14.2f %8.1f" % (len(small), ratio, name, times[0] * 1e3, times[1] * 1e3,
+                                                        times[0] / times[1]))
+
+
+def bench_engines(args):
+    """
+    Resuelve las consultas de un fichero con cada motor de SAR_Indexer.ENGINES y muestra el
+    tiempo por consulta, comprobando que todos los motores devuelven los mismos articulos.
+    La cache de resultados no se usa, se miden las operaciones con las posting lists.
+    """
+    indexer = SAR_Indexer()
+    indexer.load_info(args.index)
+    indexer.load_sections()
+    indexer.set_cache(0)
+    queries = read_queries(args.qlist)
+    reference = None
+    print("%-10s %12s" % ('engine', 'us/query'))
+    for engine in SAR_Indexer.ENGINES:
+        try:
+            indexer.set_engine(engine)
+        except ValueError as e:
+            print("%-10s %12s" % (engine, e))
+            continue
+        result = [list(indexer.solve_query(query)) for query in queries] # primera pasada para cargar las posting lists
+        t0 = time.perf_counter()
+        for _ in range(args.repeats):
+            for query in queries:
+                indexer.solve_query(query)
+        elapsed = (time.perf_counter() - t0) / args.repeats
+        if reference is None:
+            reference = result
+        elif result != reference:
+            print("ERROR: engine '{}' returns different articles".format(engine))
+        print("%-10s %12.1f" % (engine, elapsed / len(queries) * 1e6))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks for the indexer and the searcher.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_idx = subparsers.add_parser('indexing', help='indexing time as the number of articles grows.')
+    parser_idx.add_argument('dir', type=str,
+                        help='directory or file with the Wikipedia articles.')
+    parser_idx.add_argument('-n', '--sizes', dest='sizes', type=int, nargs='+', default=None,
+                        help='numbers of articles to index (default: 1/16, 1/8, 1/4, 1/2 and all the articles).')
+    parser_idx.add_argument('-M', '--multifield', dest='multifield', action='store_true', default=False,
+                        help='index all the fields.')
+    parser_idx.set_defaults(func=bench_indexing)
+
+    parser_tok = subparsers.add_parser('tokenizer', help='tokens per second of each tokenizer backend.')
+    parser_tok.add_argument('dir', type=str,
+                        help='directory or file with the Wikipedia articles.')
+    parser_tok.add_argument('-n', '--articles', dest='articles', type=int, default=None,
+                        help='maximum number of articles to tokenize.')
+    parser_tok.add_argument('-b', '--batch', dest='batch', type=int, default=100,
+                        help='number of articles tokenized at once in the batch mode.')
+    parser_tok.set_defaults(func=bench_tokenizer)
+
+    parser_wc = subparsers.add_parser('wildcard', help='permuterm against k-gram wildcard engines on the vocabulary of an index.')
+    parser_wc.add_argument('index', type=str,
+                        help='name of the index.')
+    parser_wc.add_argument('-n', '--queries', dest='queries', type=int, default=1000,
+                        help='number of wildcard queries per field.')
+    parser_wc.set_defaults(func=bench_wildcard)
+
+    parser_q = subparsers.add_parser('queries', help='query compilation and solving time with and without the plan cache.')
+    parser_q.add_argument('index', type=str,
+                        help='name of the index.')
+    parser_q.add_argument('qlist', type=str,
+                        help='file with queries (-L format) or queries and results (-T format).')
+    parser_q.add_argument('-r', '--repeats', dest='repeats', type=int, default=3,
+                        help='number of times the query file is solved.')
+    parser_q.set_defaults(func=bench_queries)
+
+    parser_int = subparsers.add_parser('intersection', help='linear against binary search AND and AND NOT for skewed posting lengths.')
+    parser_int.add_argument('-s', '--size', dest='size', type=int, default=1000000,
+                        help='number of articles of the long posting list.')
+    parser_int.add_argument('-r', '--ratios', dest='ratios', type=int, nargs='+', default=[1, 2, 4, 8, 64, 1000, 20000],
+                        help='length ratios between the long and the short posting list.')
+    parser_int.set_defaults(func=bench_intersection)
+
+    parser_eng = subparsers.add_parser('engines', help='query solving time with every posting list engine.')
+    parser_eng.add_argument('index', type=str,
+                        help='name of the index.')
+    parser_eng.add_argument('qlist', type=str,
+                        help='file with queries (-L format) or queries and results (-T format).')
+    parser_eng.add_argument('-r', '--repeats', dest='repeats', type=int, default=3,
+                        help='number of times the query file is solved.')
+    parser_eng.set_defaults(func=bench_engines)
+
+    args = parser.parse_args()
+    args.func(args)
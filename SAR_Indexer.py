@@ -1,9 +1,38 @@
 import argparse
+import json
+import os
 import pickle
 import sys
+import tempfile
 import time
 
-from SAR_lib import SAR_Indexer
+from SAR_lib import CODECS, SAR_Indexer, SAR_Profiler, SAR_Tokenizer
+
+
+def codec_report(indexer, filename):
+    """
+    Guarda el indice con cada compresor de CODECS en un directorio temporal junto a "filename"
+    y muestra el tamaño del fichero, el tiempo de guardado, el de load_info() y el de leer
+    todo el indice (load_info() deja las posting lists y las secciones en el fichero).
+
+    """
+    print('CODECS:')
+    print("\t{:8}{:>12}{:>10}{:>10}{:>16}".format('codec', 'size (MB)', 'save (s)', 'load (s)', 'full load (s)'))
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(filename))) as tmpdir:
+        for codec in CODECS:
+            name = os.path.join(tmpdir, 'index.' + codec)
+            t0 = time.time()
+            indexer.save_info(name, codec)
+            t1 = time.time()
+            loaded = SAR_Indexer()
+            loaded.load_info(name)
+            t2 = time.time()
+            loaded.load_sections()
+            t3 = time.time()
+            print("\t{:8}{:>12.2f}{:>10.2f}{:>10.3f}{:>16.2f}".format(
+                codec, os.path.getsize(name) / 2**20, t1 - t0, t2 - t1, t3 - t1))
+            del loaded
+    print()
 
 
 if __name__ == "__main__":
@@ -18,25 +47,80 @@ if __name__ == "__main__":
     parser.add_argument('-S', '--stem', dest='stem', action='store_true', default=False, 
                     help='compute stem index.')
 
+    parser.add_argument('--stem-postings', dest='stem_postings', action='store_true', default=False,
+                    help='store the posting list of every stem (with -S).')
+
     parser.add_argument('-P', '--permuterm', dest='permuterm', action='store_true', default=False,
                     help='compute permuterm index.')
 
+    parser.add_argument('--wildcard-engine', dest='wildcard_engine', choices=['permuterm', 'kgram'], default='permuterm',
+                    help='index used for wildcard queries with -P: permuterm or character 3-grams.')
+
     parser.add_argument('-M', '--multifield', dest='multifield', action='store_true', default=False, 
                     help='compute index for all the fields.')
 
     parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False, 
                     help='compute positional index.')
 
+    parser.add_argument('--bigrams', dest='bigrams', metavar='N', type=int, default=0,
+                    help='index the N most frequent word pairs of each field to speed up phrase queries (with -O).')
+
+    parser.add_argument('--tokenizer', dest='tokenizer', choices=SAR_Tokenizer.BACKENDS, default='finditer',
+                    help='tokenizer backend used to index the articles.')
+
+    parser.add_argument('-U', '--update', dest='update', action='store_true', default=False,
+                    help='add the articles to an existing index (keeping its options) instead of building a new one.')
+
+    parser.add_argument('--codec', dest='codec', choices=list(CODECS), default='none',
+                    help='compression used when saving the index.')
+
+    parser.add_argument('--codec-report', dest='codec_report', action='store_true', default=False,
+                    help='compare index size, save time and load time of every codec.')
+
+    parser.add_argument('-X', '--extended-stats', dest='extended_stats', action='store_true', default=False,
+                    help='show the memory of every structure, posting length histograms and the longest postings.')
+
+    parser.add_argument('--top', dest='top', metavar='N', type=int, default=10,
+                    help='number of longest postings shown with -X.')
+
+    parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+                    help='show the time spent in every phase of the indexing.')
+
+    parser.add_argument('--profile-json', dest='profile_json', metavar='FILE', type=str, default=None,
+                    help='write the time spent in every phase of the indexing to FILE in json format.')
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-J', '--jobs', dest='jobs', type=int, default=1,
+                    help='number of processes used to index the files.')
+
+    group.add_argument('-B', '--memory-budget', dest='memory_budget', metavar='MB', type=float, default=None,
+                    help='build the index with SPIMI, spilling sorted blocks to disk when they reach MB megabytes.')
+
     args = parser.parse_args()
 
     indexer = SAR_Indexer()
+    if args.profile or args.profile_json:
+        indexer.profiler = SAR_Profiler()
     t0 = time.time()
-    indexer.index_dir(args.dir, **vars(args))
+    if args.update and os.path.exists(args.index):
+        indexer.load_info(args.index)
+        print("Time loading: %2.2fs." % (time.time() - t0))
+        indexer.update_dir(args.dir, **vars(args))
+    else:
+        indexer.index_dir(args.dir, **vars(args))
     t1 = time.time()
-    indexer.save_info(args.index)
+    indexer.save_info(args.index, args.codec)
     t2 = time.time()
-    indexer.show_stats()
+    indexer.show_stats(args.extended_stats, args.top)
     print("Time indexing: %2.2fs." % (t1 - t0))
     print("Time saving: %2.2fs." % (t2 - t1))
     print()
+    if args.profile:
+        indexer.profiler.show()
+        print()
+    if args.profile_json:
+        with open(args.profile_json, 'w') as fh:
+            json.dump(indexer.profiler.to_json(), fh, indent=2)
+    if args.codec_report:
+        codec_report(indexer, args.index)
 
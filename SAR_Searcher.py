@@ -32,6 +32,18 @@ if __name__ == "__main__":
                     help='show all the results. If not used, only the first 10 results are showed. Does not apply with -C and -T options.')
 
 
+    parser.add_argument('-E', '--explain', dest='explain', action='store_true', default=False,
+                    help='show the plan of every query with its estimated sizes and costs.')
+
+    parser.add_argument('--engine', dest='engine', choices=SAR_Indexer.ENGINES, default='python',
+                    help='engine used to combine the posting lists: pure python merges and bitmaps, or vectorized numpy arrays.')
+
+    parser.add_argument('--cache', dest='cache', metavar='MB', type=float, default=SAR_Indexer.RESULT_CACHE_MB,
+                    help='size of the cache of sub-query results, 0 to disable it. Hits and misses are shown after -L and -T.')
+
+    parser.add_argument('--stats', dest='stats', action='store_true', default=False,
+                    help='show extended statistics of the index and exit.')
+
     group1 = parser.add_mutually_exclusive_group()
     group1.add_argument('-Q', '--query', dest='query', metavar= 'query', type=str, action='store',
                     help='query.')
@@ -47,6 +59,17 @@ if __name__ == "__main__":
     searcher.set_stemming(args.stem)
     searcher.set_showall(args.all)
     searcher.set_snippet(args.snippet)
+    searcher.set_explain(args.explain)
+    searcher.set_cache(args.cache)
+    try:
+        searcher.set_engine(args.engine)
+    except ValueError as e:
+        print(f"ERROR:{e}", file=sys.stderr)
+        sys.exit(-1)
+
+    if args.stats:
+        searcher.show_stats(extended=True)
+        sys.exit(0)
 
     # se debe contar o mostrar resultados?
     if args.count is True:
@@ -60,6 +83,7 @@ if __name__ == "__main__":
         with open(args.qlist, encoding='utf-8') as fh:
             query_list = fh.read().strip().split('\n')
         searcher.solve_and_count(query_list)
+        searcher.show_cache()
 
     elif args.test is not None:
         # opt: -T, testing
@@ -69,6 +93,7 @@ if __name__ == "__main__":
             print('\nParece que todo está bien, buen trabajo!')
         else:
             print('\nParece que hay alguna consulta mal :-(')            
+        searcher.show_cache()
 
 
     elif args.query is not None:
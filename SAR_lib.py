@@ -1,14 +1,1097 @@
+import bz2
 import json
+import lzma
 from nltk.stem.snowball import SnowballStemmer
 import os
 import re
 import sys
 import math
+import time
 from pathlib import Path
 from typing import Optional, List, Union, Dict
 import pickle
+import heapq
+import mmap
+import struct
+import zlib
+import bisect
+import tempfile
+from array import array
+from collections.abc import Mapping
+from itertools import accumulate, chain, compress, filterfalse
+from concurrent.futures import ProcessPoolExecutor
 from distutils import filelist
 
+try:
+    import resource # solo disponible en sistemas Unix
+except ImportError:
+    resource = None
+
+try:
+    import numpy as np # opcional, solo para el motor 'numpy' de las consultas
+except ImportError:
+    np = None
+
+# compresores para las secciones del fichero del indice --> (comprimir, descomprimir)
+CODECS = {
+    'none': (bytes, bytes),
+    'zlib': (zlib.compress, zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+
+class SAR_Posting:
+    """
+    Posting list compacta.
+
+    Los artid se guardan en un array('I') (4 bytes por entrada) en lugar de en listas
+    de enteros de Python (8 bytes por puntero mas el objeto int). El docid no se guarda
+    porque se puede recuperar a partir de self.articles[artid].
+
+    Cada articulo aparece una sola vez, junto a la frecuencia del termino en el articulo
+    (array paralelo "freqs"). Las posting lists que resultan de una consulta no tienen
+    frecuencias (freqs es None).
+
+    En los indices posicionales las posiciones del termino en cada articulo se guardan
+    como diferencias con la anterior (la primera es absoluta) codificadas en bytes de
+    longitud variable (7 bits por byte, ver encode_positions()), todas seguidas en "positions".
+    El array paralelo "offsets" indica donde empiezan las de cada articulo, asi solo se
+    decodifican las de los articulos que interesan.
+
+    Se comporta como una secuencia de artid: se puede recorrer, indexar y medir con len().
+    """
+
+    __slots__ = ('artids', 'freqs', 'positions', 'offsets')
+
+    def __init__(self, artids=(), freqs=None, positions=None, offsets=None):
+        self.artids = array('I', artids)
+        self.freqs = None if freqs is None else array('I', freqs)
+        self.positions = None if positions is None else bytearray(positions)
+        self.offsets = None if offsets is None else array('I', offsets)
+
+    def __getstate__(self):
+        return self.artids, self.freqs, self.positions, self.offsets
+
+    def __setstate__(self, state):
+        self.artids, self.freqs, self.positions, self.offsets = state
+
+    def append(self, artid:int) -> bool:
+        """
+        Añade una aparicion del termino en el articulo "artid".
+        Los artid se deben añadir en orden creciente, si el articulo ya es el ultimo de
+        la lista solo se incrementa su frecuencia.
+
+        return: True si se ha añadido una entrada nueva a la posting list
+        """
+        if self.freqs is None:
+            self.freqs = array('I', [1] * len(self.artids))
+        if self.artids and self.artids[-1] == artid:
+            self.freqs[-1] += 1
+            return False
+        self.artids.append(artid)
+        self.freqs.append(1)
+        return True
+
+    def append_positions(self, artid:int, positions:List[int]) -> int:
+        """
+        Añade el articulo "artid", mayor que los de la lista, con las posiciones (crecientes)
+        en las que aparece el termino.
+
+        return: bytes que ocupan las posiciones codificadas
+        """
+        if self.positions is None:
+            self.freqs = array('I')
+            self.positions = bytearray()
+            self.offsets = array('I')
+        data = encode_positions(positions)
+        self.artids.append(artid)
+        self.freqs.append(len(positions))
+        self.offsets.append(len(self.positions))
+        self.positions += data
+        return len(data)
+
+    def get_positions(self, i:int) -> List[int]:
+        """
+        Devuelve las posiciones del termino en el articulo de la posicion "i" de la posting list.
+        """
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self.positions)
+        return decode_positions(self.positions, self.offsets[i], end)
+
+    def extend(self, other:'SAR_Posting'):
+        """
+        Añade al final las entradas de "other", cuyos artid deben ser mayores que los de esta lista.
+        """
+        if self.positions is not None:
+            shift = len(self.positions)
+            self.offsets.extend(offset + shift for offset in other.offsets)
+            self.positions += other.positions
+        self.artids.extend(other.artids)
+        self.freqs.extend(other.freqs)
+
+    def remap(self, newids:Dict[int, int]) -> 'SAR_Posting':
+        """
+        Devuelve una copia con los artid cambiados segun "newids" (artid --> artid nuevo,
+        en el mismo orden) y sin las entradas de los articulos que no esten en "newids".
+        """
+        keep = [i for i, artid in enumerate(self.artids) if artid in newids]
+        result = SAR_Posting([newids[self.artids[i]] for i in keep], [self.freqs[i] for i in keep])
+        if self.positions is not None:
+            result.positions = bytearray()
+            result.offsets = array('I')
+            for i in keep:
+                end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self.positions)
+                result.offsets.append(len(result.positions))
+                result.positions += self.positions[self.offsets[i]:end]
+        return result
+
+    def df(self) -> int:
+        """
+        Devuelve la frecuencia de documento del termino: numero de articulos en los que aparece.
+        """
+        return len(self.artids)
+
+    def tf(self, i:int) -> int:
+        """
+        Devuelve la frecuencia del termino en el articulo de la posicion "i" de la posting list.
+        """
+        return 1 if self.freqs is None else self.freqs[i]
+
+    def occurrences(self) -> int:
+        """
+        Devuelve el numero total de apariciones del termino.
+        """
+        return len(self.artids) if self.freqs is None else sum(self.freqs)
+
+    def __len__(self):
+        return len(self.artids)
+
+    def __iter__(self):
+        return iter(self.artids)
+
+    def __getitem__(self, i):
+        return self.artids[i]
+
+    def __eq__(self, other):
+        if isinstance(other, SAR_Posting):
+            return self.artids == other.artids
+        return list(self.artids) == list(other)
+
+    def __repr__(self):
+        return 'SAR_Posting({})'.format(list(self.artids))
+
+    def nbytes(self) -> int:
+        """
+        Devuelve los bytes que ocupan los datos de la posting list.
+        """
+        size = self.artids.itemsize * len(self.artids)
+        if self.freqs is not None:
+            size += self.freqs.itemsize * len(self.freqs)
+        if self.positions is not None:
+            size += len(self.positions) + self.offsets.itemsize * len(self.offsets)
+        return size
+
+    def list_nbytes(self) -> int:
+        """
+        Estima los bytes que ocuparia la misma posting list con la representacion antigua:
+        un diccionario {'docid': [...], 'artid': [...]} con dos listas de Python y
+        una entrada por cada aparicion del termino.
+        """
+        return sys.getsizeof({'docid': None, 'artid': None}) + 2 * (sys.getsizeof([]) + 8 * self.occurrences())
+
+
+# traducciones entre los digitos de un entero en binario y un byte (0 o 1) por articulo, ver SAR_Bitmap
+BITS_TO_FLAGS = bytes.maketrans(b'01', b'\x00\x01')
+FLAGS_TO_BITS = bytes.maketrans(b'\x00\x01', b'01')
+
+
+class SAR_Bitmap:
+    """
+    Posting list densa como mapa de bits.
+
+    El bit i del entero self.bits indica si el articulo i esta en la lista y "size" es el
+    numero de articulos del indice. Python hace las operaciones de enteros en C palabra a
+    palabra, asi el AND, OR, diferencia y complementario de dos mapas no tienen ningun bucle
+    en Python y no dependen del numero de articulos de las listas.
+    Un mapa ocupa size / 8 bytes, menos que un array de artid (4 bytes por articulo) cuando
+    la lista tiene mas de size / 32 articulos (ver SAR_Indexer.BITMAP_RATIO).
+
+    Se comporta como una secuencia de artid igual que SAR_Posting; el array de artid
+    (self.artids) se calcula la primera vez que se usa.
+    """
+
+    __slots__ = ('bits', 'size', '_artids')
+
+    def __init__(self, bits:int=0, size:int=0):
+        self.bits = bits
+        self.size = size
+        self._artids = None
+
+    @classmethod
+    def from_artids(cls, artids, size:int) -> 'SAR_Bitmap':
+        """
+        Crea el mapa de bits de una secuencia de artid menores que "size", en cualquier orden.
+        """
+        flags = bytearray(size)
+        for artid in artids:
+            flags[artid] = 1
+        return cls(int(flags[::-1].translate(FLAGS_TO_BITS) or b'0', 2), size)
+
+    def flags(self) -> bytes:
+        """
+        Devuelve un byte por articulo: 1 si esta en la lista y 0 si no.
+        Permite filtrar una posting list corta sin convertirla en mapa de bits.
+        """
+        return format(self.bits, 'b').encode()[::-1].translate(BITS_TO_FLAGS).ljust(self.size, b'\x00')
+
+    @property
+    def artids(self) -> array:
+        if self._artids is None:
+            self._artids = array('I', compress(range(self.size), self.flags()))
+        return self._artids
+
+    def df(self) -> int:
+        return self.bits.bit_count()
+
+    def nbytes(self) -> int:
+        """
+        Devuelve los bytes que ocupa el mapa de bits.
+        """
+        return (self.size + 7) // 8
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __iter__(self):
+        return iter(self.artids)
+
+    def __getitem__(self, i):
+        return self.artids[i]
+
+    def __eq__(self, other):
+        if isinstance(other, SAR_Bitmap):
+            return self.bits == other.bits
+        return list(self.artids) == list(other)
+
+    def __repr__(self):
+        return 'SAR_Bitmap({})'.format(list(self.artids))
+
+
+class SAR_Tokenizer:
+    """
+    Tokenizador con varias implementaciones ("backends") que devuelven los mismos tokens:
+    el texto se pasa a minusculas y se divide por los simbolos no alfanumericos.
+
+        - 'sub': sustituye los simbolos por espacios con una expresion regular y divide (split)
+        - 'finditer': busca directamente las secuencias alfanumericas con una expresion regular
+        - 'translate': sustituye los simbolos por espacios con str.translate y divide (split).
+            La tabla solo cubre el plano basico de Unicode (caracteres hasta U+FFFF).
+
+    Ademas de tokenize() ofrece un generador (iter_tokens) y un modo por lotes
+    (tokenize_batch) que tokeniza muchos textos con una sola pasada.
+    """
+
+    BACKENDS = ('sub', 'finditer', 'translate')
+    # token separador del modo por lotes: no puede aparecer en un texto pasado a minusculas
+    BATCH_SEP = 'A'
+
+    def __init__(self, backend:str='finditer'):
+        if backend not in self.BACKENDS:
+            raise ValueError("Unknown tokenizer backend '{}', use one of {}".format(backend, self.BACKENDS))
+        self.backend = backend
+        self.symbols = re.compile(r"\W+")
+        self.words = re.compile(r"\w+")
+        self.table = None
+        if backend == 'translate':
+            self.table = {c: ' ' for c in range(0x10000) if self.symbols.match(chr(c))}
+
+    def __getstate__(self):
+        # la tabla de translate se reconstruye al cargar, no se guarda con el indice
+        return {'backend': self.backend}
+
+    def __setstate__(self, state):
+        self.__init__(state['backend'])
+
+    def tokenize(self, text:str) -> List[str]:
+        """
+        Devuelve la lista de tokens de "text".
+        """
+        return self.tokenize_lower(text.lower())
+
+    def tokenize_lower(self, text:str) -> List[str]:
+        """
+        Devuelve la lista de tokens de "text", que ya debe estar en minusculas.
+        """
+        if self.backend == 'sub':
+            return self.symbols.sub(' ', text).split()
+        elif self.backend == 'finditer':
+            return self.words.findall(text)
+        else:
+            return text.translate(self.table).split()
+
+    def iter_tokens(self, text:str):
+        """
+        Generador de los tokens de "text".
+        Con el backend 'finditer' los tokens se producen a medida que se encuentran.
+        """
+        if self.backend == 'finditer':
+            for match in self.words.finditer(text.lower()):
+                yield match.group()
+        else:
+            yield from self.tokenize(text)
+
+    def tokenize_batch(self, texts:List[str]) -> List[List[str]]:
+        """
+        Tokeniza una lista de textos con una sola pasada, separandolos con self.BATCH_SEP.
+        Reduce el coste por llamada cuando hay muchos textos cortos.
+
+        return: lista con la lista de tokens de cada texto
+        """
+        if not texts:
+            return []
+        if len(texts) == 1:
+            return [self.tokenize(texts[0])]
+        sep = self.BATCH_SEP
+        tokens = self.tokenize_lower(' {} '.format(sep).join(text.lower() for text in texts))
+        result = []
+        start = 0
+        for i in range(len(texts) - 1):
+            end = tokens.index(sep, start)
+            result.append(tokens[start:end])
+            start = end + 1
+        result.append(tokens[start:])
+        return result
+
+
+class SAR_Permuterm:
+    """
+    Indice permuterm de un vocabulario.
+
+    Las rotaciones de "termino$" se guardan como un array ordenado, pero cada rotacion se
+    representa con el numero del termino (array 'I') y el desplazamiento (array 'H') en lugar
+    de con la cadena, que solo se construye al compararla durante la busqueda binaria.
+    Una consulta con comodines se resuelve buscando el rango de rotaciones que empiezan por
+    un prefijo y comprobando los terminos candidatos con una expresion regular.
+    """
+
+    END = '$'
+    __slots__ = ('terms', 'termids', 'shifts')
+
+    def __init__(self, terms=()):
+        self.terms = sorted(terms)
+        rotations = [(termid, shift) for termid, term in enumerate(self.terms) for shift in range(len(term) + 1)]
+        rotations.sort(key=lambda rotation: self.rotation(*rotation))
+        self.termids = array('I', [termid for termid, shift in rotations])
+        self.shifts = array('H', [shift for termid, shift in rotations])
+
+    def rotation(self, termid:int, shift:int) -> str:
+        """
+        Devuelve la rotacion "shift" del termino "termid".
+        """
+        term = self.terms[termid] + self.END
+        return term[shift:] + term[:shift]
+
+    def __len__(self):
+        return len(self.termids)
+
+    def nbytes(self) -> int:
+        """
+        Devuelve los bytes que ocupan las rotaciones y los terminos.
+        """
+        return (self.termids.itemsize * len(self.termids) + self.shifts.itemsize * len(self.shifts)
+                + sys.getsizeof(self.terms) + sum(sys.getsizeof(term) for term in self.terms))
+
+    def bisect(self, key:str, lo:int=0) -> int:
+        """
+        Devuelve la primera posicion (a partir de "lo") cuya rotacion no es menor que "key".
+        """
+        hi = len(self.termids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.rotation(self.termids[mid], self.shifts[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, pattern:str) -> List[str]:
+        """
+        Devuelve los terminos del vocabulario que encajan con "pattern", que puede tener
+        varios comodines '*' (cualquier secuencia) y '?' (un caracter).
+
+        Se rota el patron para que el texto antes del primer comodin y despues del ultimo forme
+        un prefijo, se recorre el rango de rotaciones con ese prefijo y los terminos candidatos
+        se comprueban con el patron completo.
+        """
+        first = min(i for i, c in enumerate(pattern) if c in '*?')
+        last = max(i for i, c in enumerate(pattern) if c in '*?')
+        prefix = pattern[last + 1:] + self.END + pattern[:first]
+        lo = self.bisect(prefix)
+        hi = self.bisect(prefix + chr(sys.maxunicode), lo)
+        regex = re.compile(re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.'))
+        termids = sorted({self.termids[i] for i in range(lo, hi)})
+        return [self.terms[termid] for termid in termids if regex.fullmatch(self.terms[termid])]
+
+
+class SAR_Kgram:
+    """
+    Indice de k-gramas de caracteres de un vocabulario, alternativa al permuterm para
+    las consultas con comodines.
+
+    Para cada k-grama de "$termino$" se guarda el array ordenado de los numeros de los terminos
+    que lo contienen. Una consulta se resuelve intersectando los arrays de los k-gramas de
+    los fragmentos sin comodines y comprobando los candidatos con una expresion regular.
+    Ocupa del orden del numero de caracteres del vocabulario, no de su cuadrado como el permuterm.
+    """
+
+    END = '$'
+    __slots__ = ('k', 'terms', 'grams')
+
+    def __init__(self, terms=(), k:int=3):
+        self.k = k
+        self.terms = sorted(terms)
+        self.grams = {}
+        for termid, term in enumerate(self.terms):
+            for gram in self.kgrams(self.END + term + self.END):
+                termids = self.grams.get(gram)
+                if termids is None:
+                    self.grams[gram] = array('I', [termid])
+                elif termids[-1] != termid: # un termino puede repetir un k-grama
+                    termids.append(termid)
+
+    def kgrams(self, text:str) -> List[str]:
+        """
+        Devuelve los k-gramas de "text".
+        """
+        return [text[i:i + self.k] for i in range(len(text) - self.k + 1)]
+
+    def __len__(self):
+        return sum(len(termids) for termids in self.grams.values())
+
+    def nbytes(self) -> int:
+        """
+        Devuelve los bytes que ocupan los k-gramas, sus arrays y los terminos.
+        """
+        return (sys.getsizeof(self.grams) + sum(sys.getsizeof(gram) + termids.itemsize * len(termids)
+                                                for gram, termids in self.grams.items())
+                + sys.getsizeof(self.terms) + sum(sys.getsizeof(term) for term in self.terms))
+
+    def lookup(self, pattern:str) -> List[str]:
+        """
+        Devuelve los terminos del vocabulario que encajan con "pattern", que puede tener
+        varios comodines '*' (cualquier secuencia) y '?' (un caracter).
+
+        Como los terminos estan ordenados, el texto antes del primer comodin limita los
+        candidatos a un rango de numeros de termino, que se usa junto a los k-gramas del resto.
+        """
+        first = min(i for i, c in enumerate(pattern) if c in '*?')
+        prefix = pattern[:first]
+        lo = bisect.bisect_left(self.terms, prefix)
+        hi = bisect.bisect_left(self.terms, prefix + chr(sys.maxunicode), lo) if prefix else len(self.terms)
+        pieces = re.split(r'[*?]', pattern[first:] + self.END)
+        grams = {gram for piece in pieces for gram in self.kgrams(piece)}
+        regex = re.compile(re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.'))
+
+        candidates = None
+        arrays = []
+        for gram in grams:
+            termids = self.grams.get(gram, ())
+            start = bisect.bisect_left(termids, lo)
+            arrays.append(termids[start:bisect.bisect_left(termids, hi, start)])
+        for termids in sorted(arrays, key=len):
+            if candidates is None:
+                candidates = set(termids)
+            elif len(candidates) * 16 < len(termids):
+                # pocos candidatos: se buscan en el array en lugar de recorrerlo
+                candidates = {termid for termid in candidates if self.contains(termids, termid)}
+            else:
+                candidates = candidates.intersection(termids)
+            if not candidates:
+                return []
+        if candidates is None:
+            # fragmentos demasiado cortos, se comprueba el rango del prefijo
+            candidates = range(lo, hi)
+        return [self.terms[termid] for termid in sorted(candidates) if regex.fullmatch(self.terms[termid])]
+
+    @staticmethod
+    def contains(termids:array, termid:int) -> bool:
+        """
+        Comprueba con una busqueda binaria si "termid" esta en el array ordenado "termids".
+        """
+        i = bisect.bisect_left(termids, termid)
+        return i < len(termids) and termids[i] == termid
+
+
+def encode_positions(positions:List[int]) -> bytes:
+    """
+    Codifica una lista creciente de posiciones como diferencias con la anterior en bytes
+    de longitud variable: 7 bits por byte, empezando por los de menor peso, y el bit alto
+    a 1 si el valor continua en el byte siguiente.
+    """
+    if len(positions) == 1:
+        # caso mas habitual, el termino aparece una vez en el articulo
+        gaps = positions
+        if positions[0] < 16384:
+            position = positions[0]
+            return bytes((position,)) if position < 128 else bytes((position & 127 | 128, position >> 7))
+    else:
+        gaps = [positions[0]] + [b - a for a, b in zip(positions, positions[1:])]
+    if max(gaps) < 128:
+        return bytes(gaps)
+    data = bytearray()
+    for gap in gaps:
+        while gap >= 128:
+            data.append(gap & 127 | 128)
+            gap >>= 7
+        data.append(gap)
+    return data
+
+
+def decode_positions(data, start:int=0, end:Optional[int]=None) -> List[int]:
+    """
+    Decodifica las posiciones de data[start:end] codificadas con encode_positions().
+    """
+    data = data[start:end]
+    if not data:
+        return []
+    if max(data) < 128:
+        return list(accumulate(data))
+    positions = []
+    position = value = shift = 0
+    for byte in data:
+        if byte & 128:
+            value |= (byte & 127) << shift
+            shift += 7
+        else:
+            position += value | byte << shift
+            positions.append(position)
+            value = shift = 0
+    return positions
+
+
+class SAR_Segment(Mapping):
+    """
+    Indice invertido de un campo guardado en el fichero del indice y leido con mmap
+    (ver dump_segments()).
+
+    Se comporta como un diccionario de solo lectura termino --> posting list. Los terminos
+    estan ordenados y se buscan con busqueda binaria directamente sobre el fichero, y cada
+    posting list se lee cuando se consulta, asi al cargar el indice no se lee ninguna y el
+    sistema operativo solo trae a memoria las paginas que usan las consultas.
+
+    El fichero contiene los terminos codificados en utf-8 uno detras de otro, dos arrays de
+    enteros de 8 bytes con el inicio de cada termino y de cada posting list (mas el final de
+    la ultima) y las posting lists: cabecera POSTING_HEADER (df, bytes de las posiciones,
+    flags) seguida de los arrays artids, freqs, offsets y positions de SAR_Posting.
+    Si el segmento tiene compresor (ver CODECS), los datos de las posting lists de al menos
+    COMPRESS_BYTES bytes se comprimen cada uno por separado, asi se sigue pudiendo leer
+    solo la posting list que se consulta.
+    """
+
+    POSTING_HEADER = struct.Struct('<IIB')
+    FREQS = 1
+    POSITIONS = 2
+    COMPRESSED = 4
+    COMPRESS_BYTES = 512
+
+    def __init__(self, mm:mmap.mmap, nterms:int, term_offsets:int, posting_offsets:int,
+                 codec:str='none', swap:bool=False):
+        self.mm = mm
+        self.nterms = nterms
+        self.codec = codec
+        self.swap = swap # el fichero se escribio en una maquina con otro orden de bytes
+        self.term_offsets = self.offsets(term_offsets)
+        self.posting_offsets = self.offsets(posting_offsets)
+
+    def offsets(self, start:int):
+        """
+        Devuelve el array de nterms + 1 posiciones del fichero que empieza en "start".
+        """
+        if not self.swap:
+            # sin copiar, se lee del fichero al acceder a cada posicion
+            return memoryview(self.mm)[start:start + 8 * (self.nterms + 1)].cast('Q')
+        offsets = array('Q', self.mm[start:start + 8 * (self.nterms + 1)])
+        offsets.byteswap()
+        return offsets
+
+    def term(self, i:int) -> str:
+        return self.mm[self.term_offsets[i]:self.term_offsets[i + 1]].decode('utf-8')
+
+    def find(self, term:str) -> int:
+        """
+        Busca "term" en los terminos ordenados (el orden de los bytes utf-8 es el de str).
+
+        return: posicion del termino o -1 si no esta
+        """
+        key = term.encode('utf-8')
+        mm, offsets = self.mm, self.term_offsets
+        lo, hi = 0, self.nterms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mm[offsets[mid]:offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.nterms and mm[offsets[lo]:offsets[lo + 1]] == key:
+            return lo
+        return -1
+
+    def posting(self, i:int) -> SAR_Posting:
+        """
+        Lee la posting list del termino de la posicion "i".
+        """
+        mm = self.mm
+        start = self.posting_offsets[i]
+        df, npositions, flags = self.POSTING_HEADER.unpack_from(mm, start)
+        start += self.POSTING_HEADER.size
+        if flags & self.COMPRESSED:
+            mm = CODECS[self.codec][1](mm[start:self.posting_offsets[i + 1]])
+            start = 0
+        arrays = [array('I', mm[start:start + 4 * df])]
+        start += 4 * df
+        if flags & self.FREQS:
+            arrays.append(array('I', mm[start:start + 4 * df]))
+            start += 4 * df
+        if flags & self.POSITIONS:
+            arrays.append(array('I', mm[start:start + 4 * df]))
+            start += 4 * df
+        if self.swap:
+            for a in arrays:
+                a.byteswap()
+        posting = SAR_Posting()
+        posting.artids = arrays[0]
+        if flags & self.FREQS:
+            posting.freqs = arrays[1]
+        if flags & self.POSITIONS:
+            posting.offsets = arrays[-1]
+            posting.positions = bytearray(mm[start:start + npositions])
+        return posting
+
+    def df(self, term:str) -> int:
+        """
+        Devuelve el numero de articulos de la posting list de "term" leyendo solo su cabecera.
+        """
+        i = self.find(term)
+        return 0 if i < 0 else self.POSTING_HEADER.unpack_from(self.mm, self.posting_offsets[i])[0]
+
+    def __getitem__(self, term:str) -> SAR_Posting:
+        i = self.find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self.posting(i)
+
+    def get(self, term:str, default=None):
+        i = self.find(term)
+        return default if i < 0 else self.posting(i)
+
+    def __contains__(self, term):
+        return self.find(term) >= 0
+
+    def __len__(self):
+        return self.nterms
+
+    def __iter__(self):
+        return (self.term(i) for i in range(self.nterms))
+
+    def items(self):
+        """
+        Recorre en orden los terminos y sus posting lists leyendo el fichero de forma secuencial.
+        """
+        return ((self.term(i), self.posting(i)) for i in range(self.nterms))
+
+
+def dump_segments(fh, postings, codec:str='none') -> Dict[str, tuple]:
+    """
+    Escribe en "fh" las tuplas (campo, termino, posting list), ordenadas por campo y termino,
+    como un segmento por campo que se puede leer con SAR_Segment.
+    Las posting lists se escriben segun llegan, en memoria solo se guardan los terminos
+    del campo y las posiciones del fichero donde empieza cada uno.
+
+    param:  "codec": compresor de las posting lists grandes (ver CODECS)
+
+    return: diccionario campo --> (numero de terminos, posicion del array con el inicio de
+            los terminos, posicion del array con el inicio de las posting lists, compresor)
+    """
+    header = SAR_Segment.POSTING_HEADER
+    compress = None if codec == 'none' else CODECS[codec][0]
+    toc = {}
+    pos = fh.tell()
+    field = None
+
+    def close_field():
+        # terminos del campo y arrays con las posiciones del fichero
+        term_offsets = array('Q', (pos + offset for offset in offsets))
+        fh.write(terms)
+        term_start = pos + len(terms)
+        fh.write(term_offsets)
+        fh.write(posting_offsets)
+        toc[field] = (len(offsets) - 1, term_start, term_start + 8 * len(term_offsets), codec)
+        return term_start + 8 * (len(term_offsets) + len(posting_offsets))
+
+    for f, term, posting in postings:
+        if f != field:
+            if field is not None:
+                pos = close_field()
+            field, terms, offsets, posting_offsets = f, bytearray(), array('Q', [0]), array('Q', [pos])
+        flags = 0
+        if posting.freqs is not None:
+            flags |= SAR_Segment.FREQS
+        if posting.positions is not None:
+            flags |= SAR_Segment.POSITIONS
+        npositions = 0 if posting.positions is None else len(posting.positions)
+        data = [posting.artids]
+        if posting.freqs is not None:
+            data.append(posting.freqs)
+        if posting.positions is not None:
+            data.append(posting.offsets)
+            data.append(posting.positions)
+        if compress is not None and posting.nbytes() >= SAR_Segment.COMPRESS_BYTES:
+            packed = compress(b''.join(data))
+            if len(packed) < posting.nbytes():
+                flags |= SAR_Segment.COMPRESSED
+                data = [packed]
+        fh.write(header.pack(len(posting.artids), npositions, flags))
+        pos += header.size
+        for d in data:
+            fh.write(d)
+            pos += len(d) * (d.itemsize if isinstance(d, array) else 1)
+        posting_offsets.append(pos)
+        terms += term.encode('utf-8')
+        offsets.append(len(terms))
+    if field is not None:
+        close_field()
+    return toc
+
+
+class SAR_LazyDict(dict):
+    """
+    Diccionario campo --> estructura del indice (indice de stems, de comodines...) que lee
+    cada campo del fichero del indice la primera vez que se consulta (ver SAR_Indexer.load_info()).
+
+    Comprobar si esta un campo o contar los campos no lee nada; recorrer el diccionario
+    lee todos los campos.
+    """
+
+    def __init__(self, mm:mmap.mmap, sections:Dict[str, tuple]):
+        super().__init__()
+        self.mm = mm
+        self.sections = dict(sections) # campo --> seccion del fichero de los que aun no se han leido
+
+    def load(self, key:str):
+        value = load_section(self.mm, self.sections.pop(key))
+        dict.__setitem__(self, key, value)
+        return value
+
+    def load_all(self):
+        for key in list(self.sections):
+            self.load(key)
+
+    def __missing__(self, key):
+        if key in self.sections:
+            return self.load(key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.sections or dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __len__(self):
+        return len(self.sections) + dict.__len__(self)
+
+    def __iter__(self):
+        self.load_all()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self.load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+
+def dump_section(fh, value, codec:str='none') -> tuple:
+    """
+    Guarda "value" con pickle en la posicion actual de "fh", comprimido con "codec" (ver CODECS).
+
+    return: (posicion, bytes, compresor) de la seccion en el fichero
+    """
+    offset = fh.tell()
+    data = CODECS[codec][0](pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    fh.write(data)
+    return offset, len(data), codec
+
+
+def load_section(mm:mmap.mmap, section:tuple):
+    """
+    Lee una seccion guardada con dump_section().
+    """
+    offset, length, codec = section
+    return pickle.loads(CODECS[codec][1](mm[offset:offset + length]))
+
+
+def deep_nbytes(obj, seen:Optional[set]=None) -> int:
+    """
+    Calcula los bytes que ocupa en memoria "obj" junto con todos los objetos a los que hace
+    referencia (contenido de diccionarios, listas, tuplas y conjuntos, y atributos de los
+    objetos con __dict__ o __slots__). Cada objeto se cuenta una sola vez.
+    Los ficheros abiertos con mmap no se cuentan porque no estan en la memoria del proceso.
+
+    param:  "seen": identificadores de los objetos ya contados, para compartirlos entre llamadas
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (mmap.mmap, type)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, bytearray, int, float, array, memoryview)):
+        return size
+    if isinstance(obj, dict):
+        size += sum(deep_nbytes(key, seen) + deep_nbytes(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_nbytes(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_nbytes(vars(obj), seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, slot):
+            size += deep_nbytes(getattr(obj, slot), seen)
+    return size
+
+
+def dump_postings(fh, postings, chunk:int=10000, chunk_bytes:int=2**20):
+    """
+    Escribe en "fh" una secuencia de tuplas (campo, termino, posting list).
+
+    Las tuplas se guardan en bloques de un mismo campo con como mucho "chunk" terminos
+    o "chunk_bytes" bytes de posting lists, cada uno con su propio pickle, y la secuencia
+    termina con None. Asi se puede escribir y leer el indice sin tenerlo entero en memoria.
+    """
+    field, block, nbytes = None, [], 0
+    for f, term, posting in postings:
+        if f != field or len(block) >= chunk or nbytes >= chunk_bytes:
+            if block:
+                pickle.dump((field, block), fh, protocol=pickle.HIGHEST_PROTOCOL)
+            field, block, nbytes = f, [], 0
+        block.append((term, posting))
+        nbytes += posting.nbytes()
+    if block:
+        pickle.dump((field, block), fh, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.dump(None, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_postings(fh):
+    """
+    Lee de "fh" las tuplas (campo, termino, posting list) escritas con dump_postings().
+    """
+    while True:
+        block = pickle.load(fh)
+        if block is None:
+            return
+        field, terms = block
+        for term, posting in terms:
+            yield field, term, posting
+
+
+def merge_postings(*runs):
+    """
+    Mezcla k secuencias de (campo, termino, posting list) ordenadas por (campo, termino).
+
+    Las posting lists de un mismo termino se concatenan en el orden de las secuencias,
+    por lo que los artid de cada secuencia deben ser mayores que los de las anteriores.
+    """
+    current = None
+    for field, term, posting in heapq.merge(*runs, key=lambda run: run[:2]):
+        if current is not None and current[0] == field and current[1] == term:
+            current[2].extend(posting)
+        else:
+            if current is not None:
+                yield current
+            current = (field, term, posting)
+    if current is not None:
+        yield current
+
+
+def index_file_partial(filename:str, multifield:bool, positional:bool, tokenizer:SAR_Tokenizer, profile:bool=False):
+    """
+    Indexa un fichero en un SAR_Indexer nuevo, con artid y docid empezando en 0.
+    Se ejecuta en los procesos de SAR_Indexer.index_files_parallel().
+
+    return: indice, tabla de articulos del fichero y SAR_Profiler (None si no se pide "profile")
+    """
+    partial = SAR_Indexer()
+    partial.multifield = multifield
+    partial.positional = positional
+    partial.tokenizer = tokenizer
+    if profile:
+        partial.profiler = SAR_Profiler()
+    partial.index_file(filename)
+    return partial.index, partial.articles, partial.profiler
+
+
+# piezas de una consulta: parentesis, frases entre comillas (la ultima puede no cerrarse) y
+# terminos, los tres con un posible prefijo "campo:"
+QUERY_TOKEN = re.compile(r'(?:([\w-]+):)?(?:([()])|"([^"]*)"?|([^\s()"]+))')
+
+
+def parse_query(query:str, fields:Dict[str, bool]) -> tuple:
+    """
+    Compila una consulta en un arbol de tuplas:
+        ('and', izquierda, derecha), ('or', izquierda, derecha), ('not', hijo),
+        ('term', campo, termino), ('wildcard', campo, patron), ('phrase', campo, frase)
+        y ('empty',) para los operandos que faltan.
+
+    Los operadores "and" y "or" tienen la misma prioridad y se asocian por la izquierda,
+    "not" se aplica solo al elemento siguiente y dos elementos seguidos se unen con "and".
+    El prefijo "campo:" de un grupo entre parentesis se aplica a todos sus terminos que no
+    tengan su propio campo; un prefijo que no es un campo del indice forma parte del termino.
+
+    param:  "query": cadena con la query
+            "fields": campos del indice
+
+    return: arbol de la consulta
+    """
+    tokens = [] # (tipo, campo, texto) con tipo 'op', '(', ')', 'term' o 'phrase'
+    for field, paren, phrase, term in QUERY_TOKEN.findall(query):
+        if field and field not in fields:
+            if term:
+                term, field = field + ':' + term, ''
+            else:
+                tokens.append(('term', None, field + ':'))
+                field = ''
+        field = field or None
+        if paren:
+            tokens.append((paren, field, paren))
+        elif term:
+            kind = 'op' if field is None and term in ('and', 'or', 'not') else 'term'
+            tokens.append((kind, field, term))
+        else:
+            tokens.append(('phrase', field, phrase))
+
+    pos = 0
+    def expression(field, depth):
+        nonlocal pos
+        node = unary(field)
+        while pos < len(tokens):
+            kind, f, text = tokens[pos]
+            if kind == ')':
+                if depth > 0:
+                    break
+                pos += 1 # parentesis sin abrir
+                continue
+            op = 'and'
+            if kind == 'op' and text != 'not':
+                op = text
+                pos += 1
+            node = (op, node, unary(field))
+        return node
+
+    def unary(field):
+        nonlocal pos
+        if pos < len(tokens) and tokens[pos][0] == 'op' and tokens[pos][2] == 'not':
+            pos += 1
+            return ('not', unary(field))
+        return primary(field)
+
+    def primary(field):
+        nonlocal pos
+        if pos >= len(tokens):
+            return ('empty',)
+        kind, f, text = tokens[pos]
+        if kind == ')':
+            return ('empty',)
+        pos += 1
+        if kind == 'op': # "and" u "or" sin operando izquierdo
+            return ('empty',)
+        if kind == '(':
+            node = expression(f or field, 1)
+            if pos < len(tokens):
+                pos += 1 # ')'
+            return node
+        f = f or field or 'all'
+        if kind == 'phrase':
+            return ('phrase', f, text)
+        if '*' in text or '?' in text:
+            return ('wildcard', f, text)
+        return ('term', f, text)
+
+    if not tokens:
+        return ('empty',)
+    return expression(None, 0)
+
+
+class SAR_Profiler:
+    """
+    Tiempo acumulado y numero de veces de cada fase de la indexacion (SAR_Indexer.py --profile).
+
+    Las fases se miden con add(), que recibe el instante en el que empezo la fase
+    (time.perf_counter()) y devuelve el actual, asi se pueden encadenar fases consecutivas
+    leyendo el reloj una sola vez. Con la indexacion en paralelo las fases de los procesos
+    se suman, por lo que su tiempo acumulado puede superar al de la fase 'index_dir', y se
+    cuentan los tokens de los articulos repetidos en varios ficheros aunque luego se descarten.
+    """
+
+    def __init__(self):
+        self.phases = {} # fase --> [segundos, veces]
+        self.articles = 0
+        self.tokens = 0
+
+    def add(self, phase:str, start:float, count:int=1) -> float:
+        now = time.perf_counter()
+        entry = self.phases.get(phase)
+        if entry is None:
+            self.phases[phase] = [now - start, count]
+        else:
+            entry[0] += now - start
+            entry[1] += count
+        return now
+
+    def merge(self, other:'SAR_Profiler'):
+        """
+        Suma las fases y contadores de "other" (por ejemplo los de un proceso de la indexacion en paralelo).
+        """
+        for phase, (seconds, count) in other.phases.items():
+            entry = self.phases.setdefault(phase, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += count
+        self.articles += other.articles
+        self.tokens += other.tokens
+
+    def throughput(self) -> tuple:
+        """
+        return: articulos y tokens indexados por segundo de 'index_dir'
+        """
+        seconds = self.phases.get('index_dir', [0.0])[0]
+        if seconds == 0:
+            return 0.0, 0.0
+        return self.articles / seconds, self.tokens / seconds
+
+    def to_json(self) -> Dict:
+        articles_per_second, tokens_per_second = self.throughput()
+        return {'phases': {phase: {'seconds': seconds, 'count': count}
+                           for phase, (seconds, count) in self.phases.items()},
+                'articles': self.articles, 'tokens': self.tokens,
+                'articles_per_second': articles_per_second, 'tokens_per_second': tokens_per_second}
+
+    def show(self):
+        total = self.phases.get('index_dir', [0.0])[0]
+        print('PROFILE:')
+        print("\t{:20}{:>10}{:>10}{:>12}{:>8}".format('phase', 'time (s)', 'count', 'us/call', '%'))
+        for phase, (seconds, count) in self.phases.items():
+            print("\t{:20}{:>10.2f}{:>10}{:>12.1f}{:>8.1f}".format(
+                phase, seconds, count, seconds / max(count, 1) * 1e6, 100 * seconds / total if total else 0))
+        articles_per_second, tokens_per_second = self.throughput()
+        print("\t{} articles, {} tokens: {:.0f} articles/s, {:.0f} tokens/s".format(
+            self.articles, self.tokens, articles_per_second, tokens_per_second))
+
+
 class SAR_Indexer:
     """
     Prototipo de la clase para realizar la indexacion y la recuperacion de artículos de Wikipedia
@@ -30,9 +1113,38 @@ class SAR_Indexer:
     PAR_MARK = '%'
     # numero maximo de documento a mostrar cuando self.show_all es False
     SHOW_MAX = 10
+    # estimacion de los bytes que ocupa en memoria un termino nuevo y una entrada de su posting list
+    TERM_BYTES = 360
+    ENTRY_BYTES = 9
+    # numero de bloques de la indexacion SPIMI para el que se dimensionan los ficheros temporales
+    SPIMI_RUNS = 64
+    # numero de articulos de los que se cuentan los pares de palabras para elegir los del indice de bigramas
+    BIGRAM_SAMPLE = 500
+    # numero maximo de consultas compiladas que se guardan, ver self.compile_query()
+    PLAN_CACHE_SIZE = 1024
+    # relacion de tamaños entre dos posting lists a partir de la que se busca con busqueda binaria
+    # en la larga en lugar de recorrer las dos, ver self.and_posting() y self.minus_posting()
+    GALLOP_RATIO = 4
+    # una posting list con mas de self.artid / BITMAP_RATIO articulos se trata como densa y las
+    # operaciones en las que participa se hacen con mapas de bits (ver SAR_Bitmap)
+    BITMAP_RATIO = 32
+    # motores para las operaciones con posting lists de las consultas, ver self.set_engine()
+    ENGINES = ('python', 'numpy')
+    # megabytes por defecto de la cache de resultados de subconsultas, ver self.set_cache()
+    RESULT_CACHE_MB = 64
+    # primeros bytes del fichero del indice, seguidos de la version del formato con dos digitos (ver self.save_info())
+    SEGMENT_MAGIC = b'SARSEG'
+    FORMAT_VERSION = 1
+    # atributos que se guardan en su propia seccion del fichero y se leen al usarlos
+    LAZY_ATRIBS = ['urls', 'articles', 'stem_cache']
+    # atributos campo --> estructura que se guardan con una seccion por campo (ver SAR_LazyDict)
+    FIELD_ATRIBS = ['sindex', 'ptindex', 'bindex', 'stem_postings']
 
     all_atribs = ['urls', 'index', 'sindex', 'ptindex', 'docs', 'weight', 'articles',
-                  'tokenizer', 'stemmer', 'show_all', 'use_stemming']
+                  'tokenizer', 'stemmer', 'show_all', 'use_stemming',
+                  'multifield', 'positional', 'stemming', 'permuterm',
+                  'docid', 'artid', 'ntokens', 'stem_cache', 'stem_postings', 'wildcard_engine',
+                  'bigrams', 'bindex']
 
     def __init__(self):
         """
@@ -58,20 +1170,50 @@ class SAR_Indexer:
             'section-name': {},
             'url': {}
         } # hash para el indice invertido de stems --> clave: stem, valor: lista con los terminos que tienen ese stem
-        self.ptindex = {} # hash para el indice permuterm.
+        self.stem_cache = {} # hash de los stems ya calculados --> clave: termino, valor: stem
+        self.stem_postings = {} # hash opcional con las posting lists de los stems --> clave: campo, valor: {stem: posting list}
+        self.ptindex = {} # hash para el indice de comodines --> clave: campo, valor: SAR_Permuterm o SAR_Kgram
+        self.wildcard_engine = 'permuterm' # tipo de indice de comodines, se cambia en self.index_dir()
+        self.bindex = {} # hash para el indice de bigramas --> clave: campo, valor: {(termino, termino): posting list}
+        self.bigrams = 0 # numero de pares de palabras del indice de bigramas por campo, se cambia en self.index_dir()
+        self.bigram_candidates = None # articulos de cada par entre los primeros articulos, ver self.select_bigrams()
+        self.bigram_sample = None # artid hasta el que se cuentan los pares
         self.docs = {} # diccionario de terminos --> clave: entero(docid),  valor: ruta del fichero.
         self.weight = {} # hash de terminos para el pesado, ranking de resultados.
         self.articles = {} # hash de articulos --> clave entero (artid), valor: la info necesaria para diferencia los artículos dentro de su fichero
-        self.tokenizer = re.compile("\W+") # expresion regular para hacer la tokenizacion
+        self.tokenizer = SAR_Tokenizer() # tokenizador, el backend se elige en self.index_dir()
         self.stemmer = SnowballStemmer('spanish') # stemmer en castellano
         self.show_all = False # valor por defecto, se cambia con self.set_showall()
         self.show_snippet = False # valor por defecto, se cambia con self.set_snippet()
         self.use_stemming = False # valor por defecto, se cambia con self.set_stemming()
         self.use_ranking = False  # valor por defecto, se cambia con self.set_ranking()
+        self.show_plan = False # valor por defecto, se cambia con self.set_explain()
+        self.engine = 'python' # valor por defecto, se cambia con self.set_engine()
+        self.cache_bytes = self.RESULT_CACHE_MB * 2**20 # tamaño maximo de la cache de resultados, se cambia con self.set_cache()
+        self.result_cache = {} # resultados de subconsultas --> clave: subconsulta, valor: (posting list, bytes), ver self.cache_put()
+        self.cached_bytes = 0 # bytes que ocupan los resultados de la cache
+        self.cache_hits = 0 # aciertos y fallos de la cache de resultados
+        self.cache_misses = 0
         
+        self.multifield = False # valores por defecto, se cambian en self.index_dir()
+        self.positional = False
+        self.stemming = False
+        self.permuterm = False
+        self.index_size = None # bytes del fichero del indice, se calcula al guardar o cargar
+        self.memory_budget = None # bytes maximos del bloque en memoria en la indexacion SPIMI
+        self.block_bytes = 0 # estimacion de los bytes que ocupa self.index
+        self.runs = [] # ficheros con los bloques volcados a disco en la indexacion SPIMI
+        self.spimi_dir = None # directorio temporal para los bloques
+        self.merged_run = None # fichero con la mezcla de todos los bloques
+        self.new_terms = None # terminos nuevos por campo al actualizar un indice, ver self.update_dir()
+
         self.docid = 0
         self.artid = 0
         self.ntokens = 0
+        self.lazy = {} # atributos que aun no se han leido del fichero --> seccion del fichero, ver self.load_info()
+        self.mm = None # fichero del indice cargado con mmap
+        self.profiler = None # SAR_Profiler para medir las fases de la indexacion, None si no se mide
+        self.plan_cache = {} # consultas compiladas --> clave: texto de la consulta, valor: arbol, ver self.compile_query()
 
 
 
@@ -127,6 +1269,52 @@ class SAR_Indexer:
         self.use_stemming = v
 
 
+    def set_explain(self, v:bool):
+        """
+
+        Cambia el modo de mostrar el plan de las consultas.
+
+        input: "v" booleano.
+
+        si self.show_plan es True se mostrara el plan de cada consulta con los tamaños y costes estimados, ver self.explain_plan()
+
+        """
+        self.show_plan = v
+
+
+    def set_engine(self, v:str):
+        """
+
+        Cambia el motor con el que se resuelven las operaciones con posting lists.
+
+        input: "v" uno de ENGINES.
+
+        con 'python' las posting lists son arrays de artid o mapas de bits (SAR_Bitmap) y con
+        'numpy' arrays de NumPy ordenados, con los que las operaciones se hacen vectorizadas
+        (ver self.np_and_posting()). El motor 'numpy' necesita tener instalado NumPy.
+
+        """
+        if v not in self.ENGINES:
+            raise ValueError("Unknown engine '{}', use one of {}".format(v, self.ENGINES))
+        if v == 'numpy' and np is None:
+            raise ValueError("The 'numpy' engine needs NumPy installed")
+        self.engine = v
+
+
+    def set_cache(self, v:float):
+        """
+
+        Cambia el tamaño maximo de la cache de resultados de subconsultas.
+
+        input: "v" megabytes, 0 para no usar la cache.
+
+        ver self.cache_put()
+
+        """
+        self.cache_bytes = int(v * 2**20)
+        self.clear_cache()
+
+
 
     #############################################
     ###                                       ###
@@ -135,26 +1323,147 @@ class SAR_Indexer:
     #############################################
 
 
-    def save_info(self, filename:str):
+    def save_info(self, filename:str, codec:str='none'):
         """
         Guarda la información del índice en un fichero en formato binario
+
+        El fichero empieza por SEGMENT_MAGIC, la version del formato (FORMAT_VERSION) y la
+        posicion de la tabla de contenidos. Despues va el indice invertido como un segmento
+        por campo (ver dump_segments()), las secciones con el resto de atributos (una con los
+        pequeños, una por cada atributo de LAZY_ATRIBS y una por campo de FIELD_ATRIBS) y al
+        final la tabla de contenidos, con la posicion y el compresor de cada segmento y seccion.
+        Se escribe en un fichero temporal que luego sustituye al anterior, asi no se modifica
+        un indice que este abierto con mmap.
+
+        param:  "codec": compresor de las secciones y de las posting lists grandes (ver CODECS)
         
         """
-        info = [self.all_atribs] + [getattr(self, atr) for atr in self.all_atribs]
-        with open(filename, 'wb') as fh:
-            pickle.dump(info, fh)
+        if self.profiler is not None:
+            start = time.perf_counter()
+        atribs = [atr for atr in self.all_atribs
+                  if atr != 'index' and atr not in self.LAZY_ATRIBS and atr not in self.FIELD_ATRIBS]
+        info = [atribs] + [getattr(self, atr) for atr in atribs]
+        if self.merged_run is not None:
+            # indexacion SPIMI: el indice mezclado esta en disco ordenado por campo y termino
+            run = open(self.merged_run, 'rb')
+            postings = load_postings(run)
+        else:
+            run = None
+            postings = ((field, term, self.index[field][term]) for field in sorted(self.index)
+                        for term in sorted(self.index[field]))
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as fh:
+            fh.write(self.SEGMENT_MAGIC + b'%02d' % self.FORMAT_VERSION + bytes(8))
+            segments = dump_segments(fh, postings, codec)
+            sections = {atr: dump_section(fh, getattr(self, atr), codec) for atr in self.LAZY_ATRIBS}
+            fields = {atr: {field: dump_section(fh, value, codec) for field, value in getattr(self, atr).items()}
+                      for atr in self.FIELD_ATRIBS}
+            info = dump_section(fh, info, codec)
+            toc_offset = fh.tell()
+            pickle.dump({'version': self.FORMAT_VERSION, 'byteorder': sys.byteorder, 'info': info,
+                         'segments': segments, 'sections': sections, 'fields': fields},
+                        fh, protocol=pickle.HIGHEST_PROTOCOL)
+            fh.seek(len(self.SEGMENT_MAGIC) + 2)
+            fh.write(struct.pack('<Q', toc_offset))
+        if run is not None:
+            run.close()
+        os.replace(tmpname, filename)
+        self.index_size = os.path.getsize(filename)
+        if self.profiler is not None:
+            self.profiler.add('save', start)
 
     def load_info(self, filename:str):
         """
         Carga la información del índice desde un fichero en formato binario
+
+        Las posting lists no se leen, self.index contiene un SAR_Segment por campo que las lee
+        del fichero con mmap cuando se consultan. Lo mismo pasa con las secciones: los atributos
+        de LAZY_ATRIBS se leen la primera vez que se usan (ver self.__getattr__()) y los de
+        FIELD_ATRIBS son SAR_LazyDict que leen cada campo al consultarlo, asi la memoria y el
+        tiempo de carga dependen de los campos que usan las consultas.
+        Se pueden cargar todas las versiones del formato hasta FORMAT_VERSION y los indices
+        guardados completos con pickle por versiones anteriores.
         
         """
         #info = [self.all_atribs] + [getattr(self, atr) for atr in self.all_atribs]
+        self.clear_cache()
         with open(filename, 'rb') as fh:
-            info = pickle.load(fh)
-        atrs = info[0]
-        for name, val in zip(atrs, info[1:]):
-            setattr(self, name, val)
+            magic = fh.read(len(self.SEGMENT_MAGIC) + 2)
+            if magic.startswith(self.SEGMENT_MAGIC):
+                version = int(magic[len(self.SEGMENT_MAGIC):])
+                if version > self.FORMAT_VERSION:
+                    print(f"ERROR:{filename} uses index format version {version}, this version reads up to {self.FORMAT_VERSION}!", file=sys.stderr)
+                    sys.exit(-1)
+                toc_offset, = struct.unpack('<Q', fh.read(8))
+                fh.seek(toc_offset)
+                toc = pickle.load(fh)
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                info = load_section(mm, toc['info'])
+                atrs = info[0]
+                for name, val in zip(atrs, info[1:]):
+                    setattr(self, name, val)
+                swap = toc['byteorder'] != sys.byteorder
+                self.index = {field: {} for field, tok in self.fields}
+                for field, segment in toc['segments'].items():
+                    self.index[field] = SAR_Segment(mm, *segment, swap=swap)
+                self.mm = mm
+                self.lazy = dict(toc['sections'])
+                for atr in self.lazy:
+                    delattr(self, atr)
+                for atr, sections in toc['fields'].items():
+                    setattr(self, atr, SAR_LazyDict(mm, sections))
+            else:
+                fh.seek(0)
+                info = pickle.load(fh)
+                atrs = info[0]
+                for name, val in zip(atrs, info[1:]):
+                    setattr(self, name, val)
+                if 'index' not in atrs:
+                    # el indice invertido esta guardado por bloques despues de la cabecera
+                    self.index = {field: {} for field, tok in self.fields}
+                    for field, term, posting in load_postings(fh):
+                        self.index[field][term] = posting
+                if 'artid' not in atrs:
+                    # indices antiguos sin contadores, se recuperan para poder seguir añadiendo articulos
+                    self.artid = max(self.articles, default=-1) + 1
+                    self.docid = max(self.docs, default=-1) + 1
+                    self.ntokens = sum(len(terms) for terms in self.index.values())
+                if not isinstance(self.tokenizer, SAR_Tokenizer):
+                    # indices antiguos que guardaban la expresion regular del tokenizador
+                    self.tokenizer = SAR_Tokenizer()
+                if len(self.urls) != len(self.articles):
+                    # indices antiguos en los que no se guardaban las urls procesadas
+                    self.urls = {url for docid, line, url in self.articles.values()}
+        self.index_size = os.path.getsize(filename)
+
+    def __getattr__(self, name:str):
+        """
+        Lee del fichero del indice un atributo de LAZY_ATRIBS la primera vez que se usa.
+        Solo se llama si el atributo no existe (self.load_info() borra los que deja en el fichero).
+
+        """
+        lazy = self.__dict__.get('lazy')
+        if not lazy or name not in lazy:
+            raise AttributeError(name)
+        value = load_section(self.mm, lazy.pop(name))
+        setattr(self, name, value)
+        return value
+
+    def load_sections(self):
+        """
+        Lee todo lo que self.load_info() ha dejado en el fichero (posting lists y secciones)
+        y lo convierte en diccionarios, necesario antes de modificar el indice.
+
+        """
+        for atr in list(self.lazy):
+            getattr(self, atr)
+        for atr in self.FIELD_ATRIBS:
+            value = getattr(self, atr)
+            if isinstance(value, SAR_LazyDict):
+                setattr(self, atr, dict(value.items()))
+        for field, postings in self.index.items():
+            if isinstance(postings, SAR_Segment):
+                self.index[field] = dict(postings.items())
 
     ###############################
     ###                         ###
@@ -164,6 +1473,7 @@ class SAR_Indexer:
 
     def already_in_index(self, articles:Dict) -> bool:
         """
+        Comprueba en tiempo constante si la url del articulo ya se ha indexado (hash self.urls).
 
         Args:
             articles (Dict): diccionario con la información de un artículo
@@ -184,10 +1494,30 @@ class SAR_Indexer:
         los argumentos adicionales "**args" solo son necesarios para las funcionalidades ampliadas
 
         """
+        prof = self.profiler
+        if prof is not None:
+            start = time.perf_counter()
+        # indice cargado de disco, se pasa a memoria para poder modificarlo
+        self.load_sections()
+        self.clear_cache()
         self.multifield = args['multifield']
         self.positional = args['positional']
         self.stemming = args['stem']
         self.permuterm = args['permuterm']
+        jobs = args.get('jobs') or 1
+        first_artid = self.artid
+        if args.get('tokenizer'):
+            self.tokenizer = SAR_Tokenizer(args['tokenizer'])
+        if args.get('wildcard_engine'):
+            self.wildcard_engine = args['wildcard_engine']
+        if args.get('memory_budget'):
+            self.memory_budget = int(args['memory_budget'] * 2**20)
+        if self.positional and args.get('bigrams'):
+            self.bigrams = args['bigrams']
+            if not self.bindex:
+                # los pares mas frecuentes se eligen con los primeros articulos que se indexen
+                self.bigram_candidates = {field: {} for field, tok in self.fields if tok}
+                self.bigram_sample = self.artid + self.BIGRAM_SAMPLE
 
         file_or_dir = Path(root)
         
@@ -196,20 +1526,208 @@ class SAR_Indexer:
             self.index_file(root)
         elif file_or_dir.is_dir():
             # is a directory
-            for d, _, files in os.walk(root):
-                for filename in files:
-                    if filename.endswith('.json'):
-                        fullname = os.path.join(d, filename)
-                        self.index_file(fullname)
+            filenames = [os.path.join(d, filename) for d, _, files in os.walk(root)
+                         for filename in files if filename.endswith('.json')]
+            # el indice de bigramas necesita los articulos en orden, se indexa en un solo proceso
+            if jobs > 1 and len(filenames) > 1 and self.memory_budget is None and not self.bigrams:
+                self.index_files_parallel(filenames, jobs)
+            else:
+                for fullname in filenames:
+                    self.index_file(fullname)
         else:
             print(f"ERROR:{root} is not a file nor directory!", file=sys.stderr)
             sys.exit(-1)
 
+        if self.bigram_sample is not None:
+            self.select_bigrams()
+        if prof is not None:
+            t0 = time.perf_counter()
+        if self.runs:
+            # indexacion SPIMI: se vuelca el ultimo bloque y se mezclan todos
+            self.spill_block()
+            self.merge_runs()
+            if prof is not None:
+                t0 = prof.add('merge runs', t0)
+
         ##########################################
         ## COMPLETAR PARA FUNCIONALIDADES EXTRA ##
         ##########################################
         if self.stemming:
-            self.make_stemming()
+            self.make_stemming(self.new_terms)
+            if prof is not None:
+                t0 = prof.add('stemming', t0)
+            if args.get('stem_postings'):
+                # al actualizar solo cambian las posting lists con articulos nuevos
+                self.make_stem_postings(first_artid if self.new_terms is not None else 0)
+                if prof is not None:
+                    t0 = prof.add('stem postings', t0)
+        if self.permuterm:
+            self.make_permuterm()
+            if prof is not None:
+                t0 = prof.add('wildcard index', t0)
+        self.new_terms = None
+        if prof is not None:
+            prof.add('index_dir', start)
+
+
+    def update_dir(self, root:str, **args):
+        """
+        Añade a un indice ya cargado con self.load_info() el contenido del directorio o fichero "root".
+
+        Se mantiene la configuracion del indice cargado (multifield, stemming...), los articulos
+        cuya url ya este en self.urls se descartan y el stemming solo se calcula para los terminos
+        nuevos, asi el coste depende del tamaño de los ficheros nuevos y no del indice completo.
+
+        """
+        args = dict(args, multifield=self.multifield, positional=self.positional,
+                    stem=self.stemming, permuterm=self.permuterm, tokenizer=self.tokenizer.backend,
+                    stem_postings=bool(self.stem_postings), wildcard_engine=self.wildcard_engine,
+                    bigrams=self.bigrams)
+        self.new_terms = {field: [] for field in self.index}
+        self.index_dir(root, **args)
+
+
+    def spill_block(self):
+        """
+        Vuelca a disco el bloque en memoria (self.index) ordenado por campo y termino,
+        y lo vacia. Se usa en la indexacion SPIMI cuando el bloque supera self.memory_budget.
+
+        """
+        if self.bigram_sample is not None:
+            # los pares se eligen antes de que los primeros articulos dejen de estar en memoria
+            self.select_bigrams()
+        if self.spimi_dir is None:
+            self.spimi_dir = tempfile.TemporaryDirectory(prefix='sar_spimi_')
+        run = os.path.join(self.spimi_dir.name, 'run_{}'.format(len(self.runs)))
+        # en la mezcla se tiene en memoria un bloque de cada fichero, por eso se escriben
+        # bloques pequeños (para unos SPIMI_RUNS ficheros sin pasar de self.memory_budget)
+        chunk_bytes = max(self.memory_budget // self.SPIMI_RUNS, 2**12)
+        with open(run, 'wb') as fh:
+            dump_postings(fh, ((field, term, self.index[field][term]) for field in sorted(self.index)
+                               for term in sorted(self.index[field])),
+                          chunk=chunk_bytes // self.TERM_BYTES, chunk_bytes=chunk_bytes)
+        self.runs.append(run)
+        self.index = {field: {} for field in self.index}
+        self.block_bytes = 0
+
+
+    def merge_runs(self):
+        """
+        Mezcla los bloques volcados por spill_block() en un unico fichero (self.merged_run)
+        leyendolos a la vez de forma secuencial, sin cargarlos en memoria.
+
+        """
+        merged = os.path.join(self.spimi_dir.name, 'merged')
+        fhs = [open(run, 'rb') for run in self.runs]
+        self.ntokens = 0 # cada bloque cuenta de nuevo los terminos que ya estaban en otros
+        def count(postings):
+            for posting in postings:
+                self.ntokens = self.ntokens + 1
+                yield posting
+        with open(merged, 'wb') as out:
+            dump_postings(out, count(merge_postings(*[load_postings(fh) for fh in fhs])))
+        for fh, run in zip(fhs, self.runs):
+            fh.close()
+            os.remove(run)
+        self.runs = []
+        self.merged_run = merged
+
+
+    def iter_postings(self, field:str):
+        """
+        Recorre los terminos de un campo y sus posting lists.
+        Si el indice se ha construido con SPIMI se leen del fichero mezclado.
+
+        param:  "field": campo del indice
+
+        return: generador de tuplas (termino, posting list)
+
+        """
+        if self.merged_run is None:
+            yield from self.index[field].items()
+            return
+        with open(self.merged_run, 'rb') as fh:
+            for f, term, posting in load_postings(fh):
+                if f == field:
+                    yield term, posting
+                elif f > field:
+                    break
+
+
+    def index_files_parallel(self, filenames:List[str], jobs:int):
+        """
+        Indexa una lista de ficheros con "jobs" procesos.
+
+        Cada proceso indexa un fichero completo con artid y docid locales (empezando en 0)
+        mediante index_file_partial(). Los resultados parciales se fusionan en el mismo orden
+        que los ficheros, desplazando los identificadores, por lo que cada fichero recibe
+        un rango de artid y docid disjunto y el indice resultante es identico al secuencial.
+        El indice de stems se calcula despues sobre el vocabulario fusionado, asi cada
+        termino se procesa una sola vez aunque aparezca en muchos ficheros.
+
+        param:  "filenames": lista de ficheros generados por el Crawler
+                "jobs": numero de procesos
+
+        """
+        prof = self.profiler
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            partials = executor.map(index_file_partial, filenames,
+                                    [self.multifield] * len(filenames),
+                                    [self.positional] * len(filenames),
+                                    [self.tokenizer] * len(filenames),
+                                    [prof is not None] * len(filenames))
+            for filename, (index, articles, profiler) in zip(filenames, partials):
+                if prof is not None:
+                    prof.merge(profiler)
+                    t0 = time.perf_counter()
+                    first = self.artid
+                self.merge_partial(filename, index, articles)
+                if prof is not None:
+                    # los articulos repetidos de otros ficheros se descartan al fusionar
+                    prof.articles -= len(articles) - (self.artid - first)
+                    prof.add('merge partial', t0)
+
+
+    def merge_partial(self, filename:str, index:Dict, articles:Dict):
+        """
+        Añade al indice el resultado de indexar un fichero por separado (ver index_file_partial).
+
+        Los articulos cuya url ya este en self.urls se descartan y el resto reciben artid
+        consecutivos a partir de self.artid, que conservan el orden de las posting lists.
+
+        param:  "filename": fichero indexado
+                "index", "articles": indice y tabla de articulos del fichero con identificadores locales
+
+        """
+        self.docs[self.docid] = filename
+        newids = {} # artid local --> artid global
+        for artid, (docid, line, url) in articles.items():
+            if url in self.urls:
+                continue
+            self.urls.add(url)
+            self.articles[self.artid] = (self.docid, line, url)
+            newids[artid] = self.artid
+            self.artid = self.artid + 1
+        self.docid = self.docid + 1
+
+        # si no se ha descartado ningun articulo basta con desplazar los artid
+        shift = self.artid - len(articles) if len(newids) == len(articles) else None
+        for field, terms in index.items():
+            for term, posting in terms.items():
+                if shift is not None:
+                    posting.artids = array('I', [artid + shift for artid in posting.artids])
+                else:
+                    posting = posting.remap(newids)
+                    if not posting: # el termino solo aparece en articulos repetidos
+                        continue
+                target = self.index[field].get(term)
+                if target is None:
+                    self.index[field][term] = posting
+                    self.ntokens = self.ntokens + 1
+                    if self.new_terms is not None:
+                        self.new_terms[field].append(term)
+                else:
+                    target.extend(posting)
         
     def parse_articles(self, raw_line:str) -> Dict[str, str]:
         """
@@ -219,22 +1737,51 @@ class SAR_Indexer:
             raw_line: una linea del fichero generado por el crawler
 
         Returns:
-            Dict[str, str]: claves: 'url', 'title', 'summary', 'all', 'section-name'
+            Dict[str, str]: claves: 'url', 'title', 'summary', 'sections'
+                el texto de los campos 'all' y 'section-name' no se construye, sus tokens
+                se obtienen con self.tokenize_article()
         """
         
         articles = json.loads(raw_line)
-        sec_names = []
-        txt_secs = ''
-        for sec in articles['sections']:
-            txt_secs += sec['name'] + '\n' + sec['text'] + '\n'
-            txt_secs += '\n'.join(subsec['name'] + '\n' + subsec['text'] + '\n' for subsec in sec['subsections']) + '\n\n'
-            sec_names.append(sec['name'])
-            sec_names.extend(subsec['name'] for subsec in sec['subsections'])
-        articles.pop('sections') # no la necesitamos 
-        articles['all'] = articles['title'] + '\n\n' + articles['summary'] + '\n\n' + txt_secs
-        articles['section-name'] = '\n'.join(sec_names)
 
         return articles
+
+
+    def tokenize_article(self, article:Dict) -> Dict[str, List[str]]:
+        """
+        Tokeniza una sola vez cada texto de un articulo y reparte los tokens entre los campos.
+
+        Los tokens de 'all' son los de 'title', 'summary' y, por cada seccion y subseccion,
+        los de su nombre y su texto, en el mismo orden en el que aparecen en el articulo.
+        Los nombres de secciones y subsecciones forman el campo 'section-name'.
+
+        param:  "article": diccionario devuelto por self.parse_articles()
+
+        return: diccionario campo --> lista de tokens
+
+        """
+        # todos los textos del articulo se tokenizan en un solo lote
+        texts = [article['title'], article['summary']]
+        for sec in article['sections']:
+            texts.append(sec['name'])
+            texts.append(sec['text'])
+            for subsec in sec['subsections']:
+                texts.append(subsec['name'])
+                texts.append(subsec['text'])
+        pieces = iter(self.tokenizer.tokenize_batch(texts))
+
+        title = next(pieces)
+        summary = next(pieces)
+        all_tokens = title + summary
+        sec_names = []
+        for sec in article['sections']:
+            for subsec in [sec] + sec['subsections']:
+                name = next(pieces)
+                sec_names.extend(name)
+                all_tokens.extend(name)
+                all_tokens.extend(next(pieces))
+        return {'all': all_tokens, 'title': title, 'summary': summary, 'section-name': sec_names,
+                'url': article['url'].splitlines()} # la url se indexa sin tokenizar
                 
     
     def index_file(self, filename:str):
@@ -252,67 +1799,134 @@ class SAR_Indexer:
 
         """
 
-        self.docs[self.docid] = filename   
+        self.docs[self.docid] = filename
+        prof = self.profiler
+        if prof is not None:
+            t0 = time.perf_counter()
         for i, line in enumerate(open(filename)):
-            
+
             j = self.parse_articles(line)
-            
+            if prof is not None:
+                t0 = prof.add('read and parse', t0)
+
             url = j['url']
-            if any(url == article[2] for article in self.articles.values()):
-                # Hay al menos una coincidencia de URL en self.articles
-                pass
-            else:
-                # No hay ninguna coincidencia de URL en self.articles
-                self.articles[self.artid] = (self.docid, i, url)        
+            if self.already_in_index(j):
+                # el articulo ya esta indexado
+                continue
+            self.urls.add(url)
+            self.articles[self.artid] = (self.docid, i, url)
 
             if not self.multifield:
-                tokens = self.tokenize(j['all'])
+                fields = ['all']
+            else:
+                fields = ['all', 'title', 'summary', 'section-name', 'url']
+
+            article_tokens = self.tokenize_article(j)
+            if prof is not None:
+                t0 = prof.add('tokenize', t0)
+            for field in fields:
+                tokens = article_tokens[field]
+                if self.positional:
+                    self.index_positions(field, tokens)
+                    if self.bigrams and field != 'url':
+                        self.index_bigrams(field, tokens)
+                    continue
                 for t in tokens:
-                    #print(self.index['all'][t]['docid'])
-                    if not self.index['all'].get(t):    #si no hay ninguna entrada de ese token
-                        
-                        
-                        self.index['all'][t] = {'docid': [self.docid], 'artid': [self.artid]}# se añade la referencia al documento y articulo al que pertenece el token
+                    posting = self.index[field].get(t)
+                    if posting is None: # si no hay ninguna entrada de ese token
+                        posting = self.index[field][t] = SAR_Posting()
                         self.ntokens = self.ntokens + 1 # numero de tokens
-                        
-                    else:                 #si hay alguna entrada de ese token
-                        self.index['all'][t]["artid"].append(self.artid)
-                        self.index['all'][t]["docid"].append(self.docid)
-                self.artid = self.artid + 1
+                        self.block_bytes += self.TERM_BYTES
+                        if self.new_terms is not None:
+                            self.new_terms[field].append(t)
+                    if posting.append(self.artid): # se añade la referencia al articulo al que pertenece el token
+                        self.block_bytes += self.ENTRY_BYTES
+
+            self.artid = self.artid + 1
+            if self.bigram_sample is not None and self.artid >= self.bigram_sample:
+                self.select_bigrams()
+            if prof is not None:
+                prof.articles += 1
+                prof.tokens += len(article_tokens['all'])
+                t0 = prof.add('postings', t0)
+            if self.memory_budget is not None and self.block_bytes > self.memory_budget:
+                self.spill_block()
+                if prof is not None:
+                    t0 = prof.add('spill', t0)
+
+        self.docid = self.docid + 1 # contador de documentos
+
+    def index_positions(self, field:str, tokens:List[str]):
+        """
+        Añade al indice posicional los tokens de un campo del articulo self.artid.
+
+        Las posiciones de cada termino en el articulo se agrupan primero, asi cada posting list
+        recibe una sola entrada con todas sus posiciones codificadas (ver SAR_Posting).
 
+        param:  "field": campo del indice
+                "tokens": tokens del campo en el orden del articulo
+
+        """
+        occurrences = {}
+        for position, t in enumerate(tokens):
+            positions = occurrences.get(t)
+            if positions is None:
+                occurrences[t] = [position]
             else:
-                fields = ['all', 'title', 'summary', 'section-name', 'url']
+                positions.append(position)
+        index = self.index[field]
+        for t, positions in occurrences.items():
+            posting = index.get(t)
+            if posting is None: # si no hay ninguna entrada de ese token
+                posting = index[t] = SAR_Posting()
+                self.ntokens = self.ntokens + 1
+                self.block_bytes += self.TERM_BYTES
+                if self.new_terms is not None:
+                    self.new_terms[field].append(t)
+            self.block_bytes += self.ENTRY_BYTES + 4 + posting.append_positions(self.artid, positions)
+
+    def index_bigrams(self, field:str, tokens:List[str]):
+        """
+        Actualiza el indice de bigramas con los pares de palabras consecutivas de un campo
+        del articulo self.artid.
 
-                for field in fields:
-                    if field != 'url': # si el campo no es url tokenizamos
-                        tokens = self.tokenize(j[field])
-                        for t in tokens:
-                            
-                            if self.index[field].get(t) == None:
-                                
-                                self.index[field][t] = {'docid': [self.docid], 'artid': [self.artid]}
-                                self.ntokens = self.ntokens + 1 
-                            else:
-                               self.index[field][t]["artid"].append(self.artid)
-                               self.index[field][t]["docid"].append(self.docid)
-                    else:
+        Mientras se indexan los primeros articulos (hasta self.bigram_sample) se guardan los
+        articulos de todos los pares; despues solo se añade el articulo a las posting lists
+        de los pares elegidos por self.select_bigrams().
 
-                        aux = j['url'].splitlines() # partimos el j['url'] en lineas para comprobar que no estan ya en index igual que al principio en articles
-                        
-                        for t in aux:
-                            if self.index['url'].get(t) == None:
-                                
-                                self.index['url'][t] = {'docid': [self.docid], 'artid': [self.artid]}
-                                self.ntokens = self.ntokens + 1 
-                            else:
-                                
-                                self.index['url'][t]["artid"].append(self.artid)
-                                self.index['url'][t]["docid"].append(self.docid)
-                                
-            
-                self.artid = self.artid + 1
-            
-            self.docid = self.docid + 1 # contador de documentos
+        param:  "field": campo del indice
+                "tokens": tokens del campo en el orden del articulo
+
+        """
+        pairs = set(zip(tokens, tokens[1:]))
+        if self.bigram_sample is not None:
+            candidates = self.bigram_candidates[field]
+            for pair in pairs:
+                artids = candidates.get(pair)
+                if artids is None:
+                    candidates[pair] = [self.artid]
+                else:
+                    artids.append(self.artid)
+            return
+        bindex = self.bindex.get(field)
+        if bindex:
+            for pair in pairs:
+                posting = bindex.get(pair)
+                if posting is not None:
+                    posting.artids.append(self.artid)
+
+    def select_bigrams(self):
+        """
+        Elige para cada campo los self.bigrams pares de palabras que aparecen en mas articulos
+        de los indexados hasta ahora y conserva sus posting lists. Los pares que solo aparecen
+        en un articulo no se guardan.
+
+        """
+        for field, candidates in self.bigram_candidates.items():
+            pairs = heapq.nlargest(self.bigrams, candidates.items(), key=lambda item: len(item[1]))
+            self.bindex[field] = {pair: SAR_Posting(artids) for pair, artids in pairs if len(artids) > 1}
+        self.bigram_candidates = None
+        self.bigram_sample = None
 
         #
         # 
@@ -346,17 +1960,17 @@ class SAR_Indexer:
         NECESARIO PARA TODAS LAS VERSIONES
 
         Tokeniza la cadena "texto" eliminando simbolos no alfanumericos y dividientola por espacios.
-        Puedes utilizar la expresion regular 'self.tokenizer'.
+        Utiliza el tokenizador 'self.tokenizer'.
 
         params: 'text': texto a tokenizar
 
         return: lista de tokens
 
         """
-        return self.tokenizer.sub(' ', text.lower()).split()
+        return self.tokenizer.tokenize(text)
 
 
-    def make_stemming(self):
+    def make_stemming(self, terms:Optional[Dict[str, List[str]]]=None):
         """
 
         Crea el indice de stemming (self.sindex) para los terminos de todos los indices.
@@ -365,6 +1979,8 @@ class SAR_Indexer:
 
         "self.stemmer.stem(token) devuelve el stem del token"
 
+        param:  "terms": si se indica, solo se añaden al indice de stemming estos terminos
+                de cada campo (por ejemplo los nuevos al actualizar un indice)
 
         """
 
@@ -374,9 +1990,13 @@ class SAR_Indexer:
         else:
             multifield = ['all']
         for field in multifield:
+            if terms is None:
+                tokens = (token for token, posting in self.iter_postings(field))
+            else:
+                tokens = terms[field]
             if field != 'url':
-                for token in self.index[field].keys():
-                    steam_token = self.stemmer.stem(token)
+                for token in tokens:
+                    steam_token = self.stem(token)
                     if steam_token not in self.sindex[field]:
                         
                         self.sindex[field][steam_token] = [token]
@@ -385,7 +2005,7 @@ class SAR_Indexer:
                         if token not in self.sindex[field][steam_token]:
                             self.sindex[field][steam_token] += [token]
             else:
-                for token in self.index[field].keys():
+                for token in tokens:
                     if token not in self.sindex[field]:
                         
                         self.sindex[field][token] = [token]
@@ -397,6 +2017,58 @@ class SAR_Indexer:
         ####################################################
 
 
+    def stem(self, token:str) -> str:
+        """
+        Devuelve el stem de "token".
+
+        Los stems se guardan en self.stem_cache (que se guarda con el indice), asi cada termino
+        distinto se procesa con el stemmer una sola vez aunque aparezca en varios campos
+        o en actualizaciones del indice.
+
+        """
+        if 'stem_cache' in self.lazy:
+            # indice cargado para consultas: no compensa leer la cache para unos pocos terminos
+            return self.stemmer.stem(token)
+        stem = self.stem_cache.get(token)
+        if stem is None:
+            stem = self.stem_cache[token] = self.stemmer.stem(token)
+        return stem
+
+
+    def make_stem_postings(self, since:int=0):
+        """
+        Materializa en self.stem_postings la posting list de cada stem (la union de las de sus
+        terminos), de forma que una consulta con stemming sea una sola busqueda.
+
+        param:  "since": si es mayor que 0 el indice ya tenia las posting lists de los stems y solo
+                se añaden los articulos con artid >= since (los de una actualizacion)
+
+        """
+        for field in self.sindex:
+            if not self.sindex[field]:
+                continue
+            postings = self.stem_postings.setdefault(field, {})
+            # stem --> artids de cada uno de sus terminos, se unen todos a la vez al final
+            parts = {}
+            for token, posting in self.iter_postings(field):
+                if posting and posting[-1] >= since:
+                    stem = token if field == 'url' else self.stem(token)
+                    artids = posting.artids if since == 0 else posting.artids[bisect.bisect_left(posting.artids, since):]
+                    parts.setdefault(stem, []).append(artids)
+            # se guardan siempre como SAR_Posting: union_posting() puede devolver un SAR_Bitmap,
+            # que no se puede ampliar al actualizar el indice
+            new = {stem: SAR_Posting(self.union_posting(artids).artids) for stem, artids in parts.items()}
+            if since == 0:
+                postings.clear()
+                postings.update(new)
+                continue
+            for stem, posting in new.items():
+                if stem in postings:
+                    postings[stem].artids.extend(posting.artids)
+                else:
+                    postings[stem] = posting
+
+
     
     def make_permuterm(self):
         """
@@ -405,9 +2077,15 @@ class SAR_Indexer:
 
         NECESARIO PARA LA AMPLIACION DE PERMUTERM
 
+        Si self.wildcard_engine es 'kgram' se crea un indice de k-gramas (SAR_Kgram) en lugar del
+        permuterm; los dos se consultan igual desde self.get_permuterm().
+        Al actualizar un indice se vuelve a crear completo porque cambia el vocabulario.
 
         """
-        pass
+        engine = SAR_Kgram if self.wildcard_engine == 'kgram' else SAR_Permuterm
+        for field, tok in self.fields:
+            if (self.multifield or field == "all"):
+                self.ptindex[field] = engine(term for term, posting in self.iter_postings(field))
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
         ####################################################
@@ -415,11 +2093,16 @@ class SAR_Indexer:
 
 
 
-    def show_stats(self):
+    def show_stats(self, extended:bool=False, top:int=10):
         """
         NECESARIO PARA TODAS LAS VERSIONES
         
         Muestra estadisticas de los indices
+
+        param:  "extended": si es True tambien se muestra la memoria de cada estructura (ver
+                self.show_memory()), el histograma de longitudes de las posting lists y las
+                "top" posting lists mas largas de cada campo. Con un indice cargado con
+                self.load_info() se leen del fichero todas las estructuras.
         
         """
         print("=" * 40)
@@ -427,35 +2110,131 @@ class SAR_Indexer:
         print("-" * 40)
         print("Number of indexed articles:", len(self.articles)) #
         print("-" * 40)
-        print('TOKENS:', self.ntokens)
+        # se recorre cada campo una sola vez, el indice puede estar en disco (SPIMI)
+        stats = {}
+        extra = {} # campo --> (histograma, posting lists mas largas, bytes en memoria), solo si "extended"
         for field, tok in self.fields:
             if (self.multifield or field == "all"):
-                print("\t# of tokens in '{}': {}".format(field, len(self.index[field])))
+                terms = entries = occurrences = nbytes = list_nbytes = positions = 0
+                histogram, longest, memory = {}, [], 0
+                for term, p in self.iter_postings(field):
+                    terms += 1
+                    entries += p.df()
+                    occurrences += p.occurrences()
+                    nbytes += p.nbytes()
+                    list_nbytes += p.list_nbytes()
+                    if p.positions is not None:
+                        positions += len(p.positions)
+                    if extended:
+                        # intervalos [2^k, 2^(k+1)) de la longitud de la posting list
+                        bucket = p.df().bit_length()
+                        histogram[bucket] = histogram.get(bucket, 0) + 1
+                        if len(longest) < top:
+                            heapq.heappush(longest, (p.df(), term))
+                        elif p.df() > longest[0][0]:
+                            heapq.heapreplace(longest, (p.df(), term))
+                        memory += deep_nbytes(term) + deep_nbytes(p)
+                stats[field] = (terms, entries, occurrences, nbytes, list_nbytes, positions)
+                if extended:
+                    if isinstance(self.index[field], dict):
+                        memory += sys.getsizeof(self.index[field])
+                    extra[field] = (histogram, sorted(longest, reverse=True), memory)
+        print('TOKENS:', self.ntokens)
+        for field, (terms, entries, occurrences, nbytes, list_nbytes, positions) in stats.items():
+            print("\t# of tokens in '{}': {}".format(field, terms))
+        print("-" * 40)
+        print('POSTINGS:')
+        for field, (terms, entries, occurrences, nbytes, list_nbytes, positions) in stats.items():
+            print("\t# of postings in '{}': {} ({} occurrences, {:.2f} per posting)".format(
+                field, entries, occurrences, occurrences / max(entries, 1)))
         if (self.permuterm):
             print("-" * 40)
-            print('PERMUTERMS:')
+            print('PERMUTERMS:' if self.wildcard_engine == 'permuterm' else 'K-GRAMS:')
             for field, tok in self.fields:
                 if (self.multifield or field == "all"):
-                    print("\t# of tokens in '{}': {}".format(field, len(self.ptindex[field])))
+                    print("\t# of tokens in '{}': {} ({} terms, {:.2f} MB)".format(
+                        field, len(self.ptindex[field]), len(self.ptindex[field].terms), self.ptindex[field].nbytes() / 2**20))
         if (self.stemming):
             print("-" * 40)
             print('STEMS:')
             for field, tok in self.fields:
                 if (self.multifield or field == "all"):
                     print("\t# of tokens in '{}': {}".format(field, len(self.sindex[field])))
+            print("\tstem cache: {} tokens".format(len(self.stem_cache)))
+            if self.stem_postings:
+                print("\tstem postings are materialized.")
         print("-" * 40)
         if (self.positional):
             print('Positional queries are allowed.')
+            for field, (terms, entries, occurrences, nbytes, list_nbytes, positions) in stats.items():
+                print("\tpositions in '{}': {:.2f} MB ({:.2f} bytes per occurrence)".format(
+                    field, positions / 2**20, positions / max(occurrences, 1)))
+            for field, pairs in self.bindex.items():
+                if pairs:
+                    print("\tbigrams in '{}': {} pairs ({:.2f} MB)".format(
+                        field, len(pairs), sum(p.nbytes() for p in pairs.values()) / 2**20))
         else:    
             print('Positional queries are NOT allowed.')
+        print("-" * 40)
+        print('MEMORY:')
+        print("\tpostings (array): {:.2f} MB".format(sum(st[3] for st in stats.values()) / 2**20))
+        print("\tpostings (as python lists): {:.2f} MB".format(sum(st[4] for st in stats.values()) / 2**20))
+        if self.index_size is not None:
+            print("\tindex file size: {:.2f} MB".format(self.index_size / 2**20))
+        if resource is not None:
+            # en linux ru_maxrss se mide en KB
+            print("\tpeak resident memory: {:.2f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10))
+        if extended:
+            self.show_memory(extra)
+            print("-" * 40)
+            print('POSTING LENGTHS:')
+            for field, (histogram, longest, memory) in extra.items():
+                print("\t'{}':".format(field))
+                for bucket in sorted(histogram):
+                    low = 1 << (bucket - 1) if bucket else 0
+                    print("\t\t{:>8}-{:<8} {:>8} terms".format(low, max(2 * low - 1, 0), histogram[bucket]))
+            print("-" * 40)
+            print('LONGEST POSTINGS:')
+            for field, (histogram, longest, memory) in extra.items():
+                print("\t'{}': {}".format(field, ', '.join('{} ({})'.format(term, df) for df, term in longest)))
         print("=" * 40)
         
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
-        
 
+    def show_memory(self, extra:Dict[str, tuple]):
+        """
+        Muestra los bytes que ocupa en memoria cada estructura del indice (ver deep_nbytes()).
+
+        El indice invertido de cada campo se mide posting list a posting list al recorrerlo
+        en self.show_stats() ("extra"), asi tambien se puede medir si esta en disco (SPIMI o
+        cargado con mmap); en ese caso es lo que ocuparia cargado y no se cuenta el diccionario.
+        Las cadenas compartidas por varias estructuras se cuentan en cada una de ellas.
+
+        param:  "extra": campo --> (histograma, posting lists mas largas, bytes en memoria)
+
+        """
+        print("-" * 40)
+        print('DEEP MEMORY:')
+        total = 0
+        for field, (histogram, longest, memory) in extra.items():
+            where = '' if isinstance(self.index[field], dict) and self.merged_run is None else ' (on disk, if loaded)'
+            print("\tindex '{}': {:.2f} MB{}".format(field, memory / 2**20, where))
+            total += memory
+        for name, structure in (('stem index', self.sindex), ('stem postings', self.stem_postings),
+                                ('wildcard index', self.ptindex), ('bigram index', self.bindex)):
+            for field, value in structure.items():
+                if value:
+                    memory = deep_nbytes(value)
+                    print("\t{} '{}': {:.2f} MB".format(name, field, memory / 2**20))
+                    total += memory
+        for name in ('articles', 'urls', 'stem_cache', 'docs'):
+            memory = deep_nbytes(getattr(self, name))
+            print("\t{}: {:.2f} MB".format(name, memory / 2**20))
+            total += memory
+        print("\ttotal: {:.2f} MB".format(total / 2**20))
 
 
     #################################
@@ -469,24 +2248,6 @@ class SAR_Indexer:
     ###   PARTE 2.1: RECUPERACION   ###
     ###                             ###
     ###################################
-    def get_field(self, query):
-        """
-        Separar campo para la busqueda de query
-
-        param:  "query": cadena con el fragmeto de la query
-
-        return: campo de la busqueda, fragmento de la query
-
-        """
-        field = 'all'
-
-        if query.startswith(('all:','title', 'summary', 'section-name', 'url')):
-            field, query = query[:query.index(':')], query[query.index(':')+1:]
-
-        return field, query
-    
-
-
     def solve_query(self, query:str, prev:Dict={}):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -494,6 +2255,10 @@ class SAR_Indexer:
         Resuelve una query.
         Debe realizar el parsing de consulta que sera mas o menos complicado en funcion de la ampliacion que se implementen
 
+        La consulta se compila una sola vez en un arbol (ver self.compile_query()), que se
+        convierte en un plan segun el tamaño de las posting lists (ver self.optimize_plan()) y
+        se ejecuta con self.run_plan() sin volver a analizar ningun texto.
+        Si self.show_plan es True se muestra el plan antes de ejecutarlo.
 
         param:  "query": cadena con la query
                 "prev": incluido por si se quiere hacer una version recursiva. No es necesario utilizarlo.
@@ -504,150 +2269,334 @@ class SAR_Indexer:
         """
         # Si no hay nada en la query, se devuelve la lista vacía
         if query is None or len(query) == 0:
-            return []
-        
-        # Preproceso de la query si es un string. La convertimos en una lista de elementos (incluidos operaciones, parentesis y posicionales)
-        if isinstance(query, str): queryList = self.prepare_query_list(query)
-        else: queryList = query
-        
-        # Caso base si solo hay un elemento para el que resolver la consulta
-        self.multifield = True
-        if len(queryList) == 1:
-            element = queryList[0]
-            # Si el indice es multicampo, guardamos el campo donde se buscara. Si no lo es, buscamos en 'all'
-            if self.multifield: field, element = self.get_field(element)
-            else: field, element = 'all', query
-            # Si esta entre parentesis, los quitamos y llamamos a solve_query de la consulta interior
-            if element.startswith('(') and element.endswith(')'):
-                element = element[1:len(element)-1] 
-                return self.solve_query(element)
-            return self.get_posting(element, field)
-            
-        # Caso general: Si hay más de un elemento en la búsqueda        
-        if len(queryList) > 1:
-            opIndex = len(queryList) - 2
-            operation = queryList[opIndex]
-            beforeOp = queryList[0:opIndex]
-            afterOp = queryList[opIndex + 1]
-            # Llamadas recursivas en función de la operación a realizar
-            if operation == 'or':
-                return self.or_posting(self.solve_query(beforeOp), self.solve_query(afterOp))
-            elif operation == 'and':
-                return self.and_posting(self.solve_query(beforeOp), self.solve_query(afterOp))
-            elif operation == 'not':
-                # Si la operación es not, consultamos si hay otra operación que la precede y resolvemos
-                if opIndex > 0: opIndex -= 1; operation = queryList[opIndex] # Si not es el primer elemento de la lista, no decrementamos el puntero
-                else: return self.reverse_posting(self.solve_query(afterOp)) # Si lo es, resolvemos el not
-
-                beforeOp = queryList[0:opIndex]
-                if operation == 'or':
-                    return self.or_posting(self.solve_query(beforeOp), 
-                        self.reverse_posting(self.solve_query(afterOp)))
-                elif operation == 'and':
-                    return self.and_posting(self.solve_query(beforeOp), 
-                        self.reverse_posting(self.solve_query(afterOp)))
-
-        
+            return SAR_Posting()
+        plan = self.optimize_plan(self.compile_query(query))
+        if self.show_plan:
+            print('EXPLAIN', query)
+            print('\n'.join(self.explain_plan(plan)))
+        return self.run_plan(plan)
 
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
-        
-    def prepare_query_list(self, query):
+
+    def compile_query(self, query:str) -> tuple:
         """
-        Convierte una query en una lista de elementos, apartando los elementos entre parentesis y comillas
-        Tambien añadimos and donde sea necesario
-        Debe realizar el parsing de consulta que sera mas o menos complicado en funcion de la ampliacion que se implementen
+        Devuelve el arbol de la consulta (ver parse_query()).
+
+        Los arboles se guardan en self.plan_cache por el texto de la consulta, asi una consulta
+        repetida no se vuelve a analizar. La cache guarda como mucho PLAN_CACHE_SIZE consultas,
+        cuando se llena se descartan las mas antiguas.
+
         param:  "query": cadena con la query
-        return: lista con los elemetos mas superficiales de la query
+
+        return: arbol de la consulta
+
         """
+        plan = self.plan_cache.get(query)
+        if plan is None:
+            plan = parse_query(query, dict(self.fields))
+            if len(self.plan_cache) >= self.PLAN_CACHE_SIZE:
+                del self.plan_cache[next(iter(self.plan_cache))]
+            self.plan_cache[query] = plan
+        return plan
 
-        openPar = [m.start() for m in re.finditer(r'\(',query)]
-        closePar = [m.start() for m in re.finditer(r'\)',query)]
-        
-        # Conteo de parentesis
-        ini = []; fin = []; closed = 0
-        for index in sorted(openPar + closePar):
-            if closed == 0: ini.append(index)
-            if index in openPar:
-                closed += 1
-            else:
-                closed -= 1
-            if closed == 0: fin.append(index)
-
-        # Separar por parentesis mas externos
-        if len(ini) > 0:
-            if query[:ini[0]] != '':
-                parenList = [query[:ini[0]].strip()]
-            else: parenList = []
-            for index,element in enumerate(ini):
-                parenList.append(query[ini[index]:fin[index] + 1].strip())
-                if index + 1 < len(ini):
-                    parenList.append(query[fin[index] + 1: ini[index + 1]].strip())
-            if len(query) > fin[len(fin) - 1] + 1:
-                parenList.append(query[fin[len(fin) - 1] + 1:].strip())
-        else: parenList = [query]
-        # Separar por comillas
-        comList = []
-        for element in parenList:
-            if '\"' in element and '(' not in element:
-                comi = [m.start() for m in re.finditer(r'\"',element)]
-                if element[:comi[0]] != '': elementList = [element[:comi[0]].strip()]
-                else: elementList = []
-                for index, c in enumerate(comi):
-                    if index % 2 == 0:
-                        elementList.append(element[comi[index]:comi[index + 1] + 1])
-                    elif index < len(comi) - 1:
-                        elementList.append(element[comi[index] + 1:comi[index + 1]].strip())
-                if len(element) > comi[len(comi) - 1] + 1:
-                    elementList.append(element[comi[len(comi) - 1] + 1:].strip())
-                
-                for e in elementList: comList.append(e)
-            else:
-                comList.append(element)
-
-        # Tokenizar aquellos elementos no dependientes de comillas ni parentesis
-        spcList = []
-        for element in comList:
-            if '\"' not in element and '(' not in element:
-                elementList = element.split(' ')
-                for e in elementList: spcList.append(e.strip())
+
+    def optimize_plan(self, node:tuple) -> tuple:
+        """
+        Convierte el arbol de una consulta compilada en el plan que se ejecuta:
+            ('posting', hoja, posting list o None, tamaño, en cache, terminos, clave), ('and', [hijos], clave),
+            ('or', [hijos], clave), ('minus', hijo, [hijos que se restan], clave) y ('not', hijo, clave).
+        La clave identifica la subconsulta del nodo en la cache de resultados (ver self.cache_get()):
+        no depende del orden de los operandos de "and" y "or" ni de mayusculas y minusculas
+        en los campos tokenizados.
+
+        Las posting lists de las hojas no se recuperan aqui: si estan en la cache de resultados
+        se usan con su tamaño exacto y si no se guarda None y el tamaño estimado con
+        self.estimate_posting(), y se recuperan al ejecutar el plan (ver self.run_plan()).
+        Los comodines que se resuelven con self.ptindex se buscan una sola vez, aqui: el nodo
+        guarda los terminos que encajan y su tamaño es la suma de sus df.
+        Con esos tamaños:
+            - los "and" y "or" anidados se agrupan en un solo nodo con todos los operandos,
+            - los operandos de un "and" se ordenan de menor a mayor tamaño estimado,
+            - "a and not b" se resuelve como la diferencia de a y b (self.minus_posting()) en
+              lugar de calcular el complementario de b, y "not a and not b" como "not (a or b)",
+            - "not not a" es "a".
+        El plan no se guarda en self.plan_cache porque depende de la cache de resultados.
+
+        param:  "node": nodo del arbol de la consulta
+
+        return: nodo del plan
+
+        """
+        kind = node[0]
+        if kind == 'not':
+            child = self.optimize_plan(node[1])
+            return child[1] if child[0] == 'not' else ('not', child, ('not', child[-1]))
+        if kind in ('and', 'or'):
+            children = []
+            for child in self.flatten_plan(kind, node):
+                child = self.optimize_plan(child)
+                children.extend(child[1] if child[0] == kind else [child])
+            children.sort(key=self.plan_size)
+            if kind == 'or':
+                return self.group_plan('or', children)
+            positive = [child for child in children if child[0] != 'not']
+            negative = [child[1] for child in children if child[0] == 'not']
+            if not positive:
+                plan = negative[0] if len(negative) == 1 else self.group_plan('or', negative)
+                return ('not', plan, ('not', plan[-1]))
+            plan = positive[0] if len(positive) == 1 else self.group_plan('and', positive)
+            if not negative:
+                return plan
+            return ('minus', plan, negative, ('minus', plan[-1], frozenset(child[-1] for child in negative)))
+        if kind == 'empty':
+            return ('posting', node, SAR_Posting(), 0, False, None, node)
+        # como en self.get_posting(), solo los campos tokenizados no distinguen mayusculas (url si)
+        text = node[2].lower() if dict(self.fields).get(node[1], True) else node[2]
+        key = (kind, node[1], text)
+        posting = self.cache_get(key)
+        if posting is not None:
+            return ('posting', node, posting, len(posting), True, None, key)
+        if kind == 'wildcard' and self.permuterm:
+            terms = self.ptindex[node[1]].lookup(text) if node[1] in self.ptindex else []
+            size = min(sum(self.get_df(term, node[1]) for term in terms), self.artid)
+            return ('posting', node, None, size, False, terms, key)
+        return ('posting', node, None, self.estimate_posting(self.leaf_term(node), node[1]), False, None, key)
+
+
+    def leaf_term(self, node:tuple) -> str:
+        """
+        Devuelve el termino que se pasa a self.get_posting() para una hoja del arbol de la consulta.
+        """
+        return '"' + node[2] + '"' if node[0] == 'phrase' else node[2]
+
+
+    def group_plan(self, kind:str, children:List[tuple]) -> tuple:
+        """
+        Devuelve el nodo del plan de un "and" u "or" de varios operandos.
+        """
+        return (kind, children, (kind, frozenset(child[-1] for child in children)))
+
+
+    def flatten_plan(self, kind:str, node:tuple) -> List[tuple]:
+        """
+        Devuelve los operandos de una cadena de operadores "kind" ('and' u 'or') del arbol de la consulta.
+        """
+        if node[0] != kind:
+            return [node]
+        return self.flatten_plan(kind, node[1]) + self.flatten_plan(kind, node[2])
+
+
+    def plan_size(self, node:tuple) -> int:
+        """
+        Devuelve una cota superior del numero de articulos del resultado de un nodo del plan.
+        """
+        kind = node[0]
+        if kind == 'posting':
+            return node[3]
+        if kind == 'and':
+            return min(self.plan_size(child) for child in node[1])
+        if kind == 'or':
+            return min(sum(self.plan_size(child) for child in node[1]), self.artid)
+        if kind == 'minus':
+            return self.plan_size(node[1])
+        return self.artid - node[1][3] if node[1][0] == 'posting' and node[1][4] else self.artid # 'not'
+
+
+    def plan_cost(self, node:tuple) -> int:
+        """
+        Devuelve el coste estimado de un nodo del plan: numero de entradas de posting lists que
+        recorren las mezclas del nodo y de sus hijos (ver self.merge_cost()).
+        """
+        kind = node[0]
+        if kind == 'posting':
+            return 0
+        if kind == 'not':
+            return self.plan_cost(node[1]) + self.merge_cost(self.artid, self.plan_size(node[1]))
+        if kind == 'minus':
+            children = [node[1]] + node[2]
+        else:
+            children = node[1]
+        cost = sum(self.plan_cost(child) for child in children)
+        if kind == 'or':
+            # union de todos los operandos en una sola pasada, ver self.union_posting()
+            return cost + sum(self.plan_size(child) for child in children)
+        size = self.plan_size(children[0])
+        for child in children[1:]:
+            cost += self.merge_cost(size, self.plan_size(child))
+            if kind == 'and':
+                size = min(size, self.plan_size(child))
+        return cost
+
+
+    def merge_cost(self, len1:int, len2:int) -> int:
+        """
+        Devuelve el numero estimado de entradas que se comparan al mezclar dos posting lists:
+        len1 + len2 si se recorren las dos, o len(corta) * log2(len(larga)) si se usa busqueda
+        binaria (ver self.and_posting()).
+        """
+        short, long = sorted((len1, len2))
+        if long > self.GALLOP_RATIO * short:
+            return short * max(1, long.bit_length())
+        return short + long
+
+
+    def explain_plan(self, node:tuple, depth:int=0) -> List[str]:
+        """
+        Devuelve las lineas con el plan de una consulta (ver self.optimize_plan()): una por nodo,
+        sangradas segun la profundidad, con el tamaño y el coste estimados. Se marcan con
+        (cached) las hojas cuya posting list estaba en la cache al planificar y los demas nodos
+        cuyo resultado esta en la cache.
+        """
+        kind = node[0]
+        if kind == 'posting':
+            leaf = node[1]
+            label = 'EMPTY' if leaf[0] == 'empty' else '{} {}:{}'.format(leaf[0].upper(), leaf[1], self.leaf_term(leaf))
+            children = []
+            cached = node[4]
+        else:
+            label = kind.upper()
+            children = [node[1]] + node[2] if kind == 'minus' else node[1] if kind in ('and', 'or') else [node[1]]
+            cached = self.cache_bytes and self.cache_key(node[-1]) in self.result_cache
+        cached = ' (cached)' if cached else ''
+        lines = ['{:48} size={:<10d} cost={}{}'.format('  ' * depth + label, self.plan_size(node), self.plan_cost(node), cached)]
+        for child in children:
+            lines.extend(self.explain_plan(child, depth + 1))
+        return lines
+
+
+    def run_plan(self, node:tuple):
+        """
+        Ejecuta un plan obtenido con self.optimize_plan().
+        Los "and" se resuelven de la posting list mas corta a la mas larga y se detienen en
+        cuanto el resultado queda vacio, sin recuperar las posting lists de las hojas restantes.
+        El resultado de cada nodo se busca antes en la cache de resultados y se guarda en ella,
+        asi las subconsultas que se repiten entre consultas solo se calculan una vez.
+
+        param:  "node": nodo del plan
+
+        return: posting list con el resultado del nodo
+
+        """
+        kind = node[0]
+        if kind == 'posting':
+            if node[2] is not None:
+                return node[2]
+            # no estaba en la cache al planificar (self.cache_get() ya conto el fallo)
+            if node[5] is not None:
+                posting = self.get_permuterm(node[1][2], node[1][1], node[5])
             else:
-                spcList.append(element)
-
-        # Insertar ands donde haga falta (y unificar en un elemento busqueda posicional y su field)
-        queryFinal = []
-        needAnd = False # Booleano para saber si hace falta un and
-        for ind, word in enumerate(spcList):
-            word = word.strip()
-            if word in ['all:','title', 'summary', 'section-name', 'url'] and spcList[ind+1].startswith('"'):
-                spcList[ind+1] = word + spcList[ind+1]
-                if needAnd:
-                    queryFinal.append('and')
-                    needAnd = False
-            elif not needAnd:
-                queryFinal.append(word)
-                needAnd = True
-                if word == 'not':
-                    needAnd = False
-            elif needAnd:
-                if word in ['or','and']:
-                    queryFinal.append(word)
-                    needAnd = False
-                else:
-                    queryFinal.append('and')
-                    queryFinal.append(word)
-                    if word == 'not':
-                        needAnd = False
+                posting = self.get_posting(self.leaf_term(node[1]), node[1][1])
+            return self.cache_put(node[-1], posting)
+        result = self.cache_get(node[-1])
+        if result is not None:
+            return result
+        if kind == 'and':
+            result = self.run_plan(node[1][0])
+            for child in node[1][1:]:
+                if len(result) == 0:
+                    break
+                result = self.and_posting(result, self.run_plan(child))
+        elif kind == 'or':
+            result = self.union_posting([self.run_plan(child) for child in node[1]])
+        elif kind == 'minus':
+            result = self.run_plan(node[1])
+            for child in node[2]:
+                if len(result) == 0:
+                    break
+                result = self.minus_posting(result, self.run_plan(child))
+        else: # 'not'
+            result = self.reverse_posting(self.run_plan(node[1]))
+        return self.cache_put(node[-1], result)
+
+
+    def cache_key(self, key:tuple) -> tuple:
+        """
+        Completa la clave de una subconsulta con lo que cambia su resultado sin cambiar la
+        consulta: si se usa stemming y el motor de las posting lists.
+        """
+        return (self.use_stemming, self.engine, key)
 
-        return queryFinal    
-        
-        
-        
-        
+
+    def cache_get(self, key:tuple):
+        """
+        Devuelve el resultado de una subconsulta guardado en la cache (ver self.cache_put()) o
+        None si no esta, y cuenta el acierto o el fallo. La subconsulta pasa a ser la usada
+        mas recientemente.
+        """
+        if not self.cache_bytes:
+            return None
+        key = self.cache_key(key)
+        entry = self.result_cache.pop(key, None)
+        if entry is None:
+            self.cache_misses += 1
+            return None
+        self.cache_hits += 1
+        self.result_cache[key] = entry
+        return entry[0]
+
+
+    def cache_put(self, key:tuple, result):
+        """
+        Guarda el resultado de una subconsulta en la cache de resultados.
+
+        La cache ocupa como mucho self.cache_bytes bytes contando lo que ocupa cada posting list
+        (los SAR_Bitmap con la lista de artid que crean al leer .artids);
+        cuando se pasa se descartan las subconsultas usadas hace mas tiempo (LRU). Los resultados
+        que no caben solos en la cache no se guardan y de las posting lists del indice solo se
+        guardan los artid, no las frecuencias ni las posiciones.
+
+        return: "result"
+        """
+        if not self.cache_bytes:
+            return result
+        if isinstance(result, SAR_Posting) and result.freqs is not None:
+            # posting list del indice: para las consultas solo hacen falta los artid
+            result = SAR_Posting(result.artids)
+        size = result.nbytes if np is not None and isinstance(result, np.ndarray) else result.nbytes()
+        if isinstance(result, SAR_Bitmap):
+            # al leer .artids el mapa de bits guarda tambien la lista de artid (4 bytes por articulo)
+            size += 4 * len(result)
+        if size > self.cache_bytes:
+            return result
+        key = self.cache_key(key)
+        old = self.result_cache.pop(key, None)
+        if old is not None:
+            self.cached_bytes -= old[1]
+        self.result_cache[key] = (result, size)
+        self.cached_bytes += size
+        while self.cached_bytes > self.cache_bytes:
+            oldest = next(iter(self.result_cache))
+            self.cached_bytes -= self.result_cache.pop(oldest)[1]
+        return result
+
+
+    def clear_cache(self):
+        """
+        Vacia la cache de resultados y pone a cero sus contadores. Se llama cuando cambia el indice.
+        """
+        self.result_cache = {}
+        self.cached_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
 
 
+    def show_cache(self):
+        """
+        Muestra los aciertos y fallos de la cache de resultados y lo que ocupa.
+        """
+        lookups = self.cache_hits + self.cache_misses
+        print("=" * 40)
+        print('RESULT CACHE:')
+        print("	hits: {}".format(self.cache_hits))
+        print("	misses: {}".format(self.cache_misses))
+        print("	hit rate: {:.1f}%".format(100 * self.cache_hits / lookups if lookups else 0))
+        print("	entries: {}".format(len(self.result_cache)))
+        print("	size: {:.2f} MB of {:.2f} MB".format(self.cached_bytes / 2**20, self.cache_bytes / 2**20))
+        print("=" * 40)
+
 
     def get_posting(self, term:str, field:Optional[str]=None):
         """
@@ -668,16 +2617,28 @@ class SAR_Indexer:
 
         """
         # Llamada al get que corresponde según los parámetros indicados
-        solution = []
-        self.permuterm = False
-        self.positional = False
-        self.stemming = False
+        solution = SAR_Posting()
+        wildcard = '*' in term or '?' in term
+        tokenized = dict(self.fields).get(field, True)
+        if tokenized and not wildcard and '\"' not in term:
+            # el termino se normaliza con el mismo tokenizador que los articulos
+            tokens = self.tokenizer.tokenize(term)
+            if len(tokens) != 1:
+                # los simbolos dividen el termino en varios tokens, se buscan todos
+                for i, token in enumerate(tokens):
+                    posting = self.get_posting(token, field)
+                    solution = posting if i == 0 else self.and_posting(solution, posting)
+                return solution
+            term = tokens[0]
+        elif tokenized and wildcard:
+            # los campos sin tokenizar (url) se indexan tal cual, sin pasar a minusculas
+            term = term.lower()
+
         if self.permuterm and ('*' in term or '?' in term):
             solution =  self.get_permuterm(term, field)
         elif self.positional:
             if '\"' in term:
-                term = term.replace('\"','')
-                solution = self.get_positionals(term.split(' '), field)
+                solution = self.get_positionals(self.tokenizer.tokenize(term), field)
             elif self.stemming and self.use_stemming:
                 solution =  self.get_stemming(term, field)
             else:
@@ -685,7 +2646,7 @@ class SAR_Indexer:
         elif self.stemming and self.use_stemming:
             solution =  self.get_stemming(term, field)
         else:
-            solution =  self.index[field][term]
+            solution =  self.index[field].get(term, solution)
 
         return solution
         ########################################
@@ -695,7 +2656,7 @@ class SAR_Indexer:
 
 
 
-    def get_positionals(self, terms:str, index):
+    def get_positionals(self, terms:List[str], field:str='all'):
         """
 
         Devuelve la posting list asociada a una secuencia de terminos consecutivos.
@@ -706,13 +2667,116 @@ class SAR_Indexer:
 
         return: posting list
 
+        La interseccion recorre los articulos de la posting list mas corta y busca cada uno en
+        las demas con busqueda binaria; solo en los articulos en los que aparecen todos los
+        terminos se decodifican las posiciones, empezando por el termino menos frecuente.
+        Asi el coste depende del termino mas raro y no del total de posiciones.
+        Los pares de la frase que esten en el indice de bigramas (self.bindex) se usan como
+        posting lists adicionales que descartan articulos antes de mirar las posiciones, y una
+        frase de dos terminos que sea uno de esos pares se resuelve sin posiciones.
+
         """
-        pass
+        postings = []
+        for offset, term in enumerate(terms):
+            posting = self.index[field].get(term)
+            if posting is None:
+                return SAR_Posting()
+            postings.append((len(posting), offset, posting))
+        if not postings:
+            return SAR_Posting()
+        if len(postings) == 1:
+            return postings[0][2]
+        filters = []
+        bigrams = self.bindex.get(field)
+        if bigrams:
+            for pair in zip(terms, terms[1:]):
+                posting = bigrams.get(pair)
+                if posting is not None:
+                    filters.append(posting)
+            if len(terms) == 2 and filters:
+                return filters[0]
+        postings.sort(key=lambda entry: entry[0])
+        lead = min(filters + [postings[0][2]], key=len)
+        lists = [posting.artids for posting in filters] + [posting.artids for df, offset, posting in postings]
+        starts = [0] * len(lists) # busqueda en cada posting list a partir del ultimo articulo encontrado
+
+        respost = array('I')
+        for artid in lead.artids:
+            found = []
+            for j, artids in enumerate(lists):
+                k = bisect.bisect_left(artids, artid, starts[j])
+                starts[j] = k
+                if k == len(artids) or artids[k] != artid:
+                    break
+                found.append(k)
+            else:
+                # posiciones de inicio de la frase compatibles con todos los terminos
+                candidates = None
+                for (df, offset, posting), k in zip(postings, found[len(filters):]):
+                    starts_at = (p - offset for p in posting.get_positions(k))
+                    if candidates is None:
+                        candidates = set(starts_at)
+                    else:
+                        candidates.intersection_update(starts_at)
+                    if not candidates:
+                        break
+                else:
+                    respost.append(artid)
+        return SAR_Posting(respost)
         ########################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE POSICIONALES ##
         ########################################################
 
 
+    def get_df(self, term:str, field:Optional[str]=None) -> int:
+        """
+        Devuelve el numero de articulos en los que aparece un termino del indice, sin decodificar
+        su posting list si el indice esta en un segmento (ver SAR_Segment.df()).
+        """
+        index = self.index[field]
+        if isinstance(index, SAR_Segment):
+            return index.df(term)
+        return len(index.get(term, ()))
+
+
+    def estimate_posting(self, term:str, field:Optional[str]=None) -> int:
+        """
+        Devuelve una cota superior del tamaño de la posting list que devolveria
+        self.get_posting(term, field) sin calcularla: se consultan solo los df de los terminos
+        del indice, asi planificar una consulta no cuesta lo que recuperar sus frases,
+        comodines y stems.
+
+        param:  "term": termino como en self.get_posting()
+                "field": campo sobre el que se busca el termino
+
+        return: numero maximo de articulos del resultado
+
+        """
+        wildcard = '*' in term or '?' in term
+        tokenized = dict(self.fields).get(field, True)
+        if tokenized and not wildcard and '\"' not in term:
+            tokens = self.tokenizer.tokenize(term)
+            if len(tokens) != 1:
+                return min((self.estimate_posting(token, field) for token in tokens), default=0)
+            term = tokens[0]
+        elif tokenized and wildcard:
+            # los campos sin tokenizar (url) se indexan tal cual, sin pasar a minusculas
+            term = term.lower()
+
+        if self.permuterm and ('*' in term or '?' in term):
+            if field not in self.ptindex:
+                return 0
+            return min(sum(self.get_df(token, field) for token in self.ptindex[field].lookup(term)), self.artid)
+        if self.positional and '\"' in term:
+            return min((self.get_df(token, field) for token in self.tokenizer.tokenize(term)), default=0)
+        if self.stemming and self.use_stemming:
+            stem = term if field == 'url' else self.stem(term)
+            if field in self.stem_postings:
+                return len(self.stem_postings[field].get(stem, ()))
+            return min(sum(self.get_df(token, field) for token in self.sindex[field].get(stem, [])), self.artid)
+        return self.get_df(term, field)
+
+
     def get_stemming(self, term:str, field: Optional[str]=None):
         """
 
@@ -726,19 +2790,20 @@ class SAR_Indexer:
 
         """
         
-        stem = self.stemmer.stem(term)
+        stem = term if field == 'url' else self.stem(term)
 
-        pos_list = []
-        if (stem in self.sindex[field]):
-            for token in self.sindex[field][stem]:
-                pos_list = self.or_posting(pos_list, list(self.index[field][token].keys()))
-        return pos_list
+        if field in self.stem_postings:
+            # posting lists de los stems materializadas al indexar
+            return self.stem_postings[field].get(stem, SAR_Posting())
+
+        terms = self.sindex[field].get(stem, [])
+        return self.union_posting([self.index[field][token] for token in terms])
 
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
         ####################################################
 
-    def get_permuterm(self, term:str, field:Optional[str]=None):
+    def get_permuterm(self, term:str, field:Optional[str]=None, terms:Optional[List[str]]=None):
         """
 
         Devuelve la posting list asociada a un termino utilizando el indice permuterm.
@@ -746,6 +2811,7 @@ class SAR_Indexer:
 
         param:  "term": termino para recuperar la posting list, "term" incluye un comodin (* o ?).
                 "field": campo sobre el que se debe recuperar la posting list, solo necesario se se hace la ampliacion de multiples indices
+                "terms": terminos del indice que encajan con "term" si ya se han buscado (ver self.optimize_plan())
 
         return: posting list
 
@@ -754,7 +2820,11 @@ class SAR_Indexer:
         ##################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA PERMUTERM ##
         ##################################################
-        pass
+        if terms is None:
+            if field not in self.ptindex:
+                return SAR_Posting()
+            terms = self.ptindex[field].lookup(term)
+        return self.union_posting([self.index[field][token] for token in terms])
 
 
 
@@ -772,9 +2842,10 @@ class SAR_Indexer:
         return: posting list con todos los artid exceptos los contenidos en p
 
         """
-        news = self.news.keys()
-        p = [newId for newId, f in p]
-        return [[newId,0] for newId in news if newId not in p]
+        if self.engine == 'numpy':
+            return self.np_reverse_posting(p)
+        # los artid son consecutivos desde 0: el complementario es invertir los bits de p
+        return SAR_Bitmap(((1 << self.artid) - 1) & ~self.to_bitmap(p).bits, self.artid)
       
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
@@ -782,33 +2853,72 @@ class SAR_Indexer:
 
 
 
+    def dense(self, p) -> bool:
+        """
+        Indica si una posting list es un mapa de bits o tiene mas de self.artid / BITMAP_RATIO articulos.
+        """
+        return isinstance(p, SAR_Bitmap) or len(p) * self.BITMAP_RATIO > self.artid
+
+
+    def to_bitmap(self, p) -> SAR_Bitmap:
+        """
+        Devuelve una posting list como mapa de bits sobre todos los articulos del indice.
+        """
+        if isinstance(p, SAR_Bitmap):
+            return p
+        return SAR_Bitmap.from_artids(getattr(p, 'artids', p), self.artid)
+
+
     def and_posting(self, p1:list, p2:list):
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
         Calcula el AND de dos posting list de forma EFICIENTE
 
+        Si una lista es mas de GALLOP_RATIO veces mas larga que la otra, cada artid de la corta
+        se busca en la larga con busqueda binaria a partir del ultimo encontrado, asi el coste
+        es del orden de len(corta) * log(len(larga)) en lugar de len(corta) + len(larga).
+
         param:  "p1", "p2": posting lists sobre las que calcular
 
 
         return: posting list con los artid incluidos en p1 y p2
 
         """
-        if p1 == [] or p2 == []: return []
-        respost = []
+        if self.engine == 'numpy':
+            return self.np_and_posting(p1, p2)
+        if self.dense(p1) and self.dense(p2):
+            return SAR_Bitmap(self.to_bitmap(p1).bits & self.to_bitmap(p2).bits, self.artid)
+        if isinstance(p1, SAR_Bitmap) or isinstance(p2, SAR_Bitmap):
+            bitmap, p = (p1, p2) if isinstance(p1, SAR_Bitmap) else (p2, p1)
+            return SAR_Posting(filter(bitmap.flags().__getitem__, getattr(p, 'artids', p)))
+        respost = array('I')
+        p1 = getattr(p1, 'artids', p1); p2 = getattr(p2, 'artids', p2)
+        if len(p1) > len(p2):
+            p1, p2 = p2, p1
+        len1 = len(p1); len2 = len(p2)
+        if len2 > self.GALLOP_RATIO * len1:
+            k = 0
+            for artid in p1:
+                k = bisect.bisect_left(p2, artid, k)
+                if k == len2:
+                    break
+                if p2[k] == artid:
+                    respost.append(artid)
+                    k += 1
+            return SAR_Posting(respost)
         iP1 = 0; iP2 = 0
-        while iP1 < len(p1) and iP2 < len(p2):
+        while iP1 < len1 and iP2 < len2:
             dataP1 = p1[iP1]
             dataP2 = p2[iP2]
-            if dataP1[0] == dataP2[0]:
-                #dataP1[1] += dataP2[1]
+            if dataP1 == dataP2:
                 respost.append(dataP1)
                 iP1 += 1; iP2 += 1
-            elif dataP1[0] > dataP2[0]:
+            elif dataP1 > dataP2:
                 iP2 += 1
             else:
                 iP1 += 1
-        return respost
+        return SAR_Posting(respost)
        
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
@@ -828,35 +2938,70 @@ class SAR_Indexer:
         return: posting list con los artid incluidos de p1 o p2
 
         """
-        respost = []
+        if self.engine == 'numpy':
+            return self.np_or_posting(p1, p2)
+        if self.dense(p1) or self.dense(p2):
+            return SAR_Bitmap(self.to_bitmap(p1).bits | self.to_bitmap(p2).bits, self.artid)
+        respost = array('I')
         iP1 = 0; iP2 = 0
-        while iP1 < len(p1) and iP2 < len(p2):
+        len1 = len(p1); len2 = len(p2)
+        while iP1 < len1 and iP2 < len2:
             dataP1 = p1[iP1]
             dataP2 = p2[iP2]
-            if dataP1[0] == dataP2[0]:
+            if dataP1 == dataP2:
                 respost.append(dataP1)
                 iP1 += 1; iP2 += 1
-            elif dataP1[0] > dataP2[0]:
+            elif dataP1 > dataP2:
                 respost.append(dataP2)
                 iP2 += 1
             else:
                 respost.append(dataP1)
                 iP1 += 1
-
-        while iP1 < len(p1):
-            respost.append(p1[iP1])
-            iP1 += 1
-        while iP2 < len(p2):
-            respost.append(p2[iP2])
-            iP2 += 1
-
-        return respost
+        # se añade lo que quede de la lista que no se ha terminado
+        respost.extend(p1[iP1:])
+        respost.extend(p2[iP2:])
+        return SAR_Posting(respost)
     
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
 
+    def union_posting(self, postings:List) -> SAR_Posting:
+        """
+        Calcula el OR de varias posting lists a la vez.
+
+        Sustituye a ir uniendo las listas de dos en dos con self.or_posting(), que vuelve a
+        copiar el resultado acumulado por cada lista y es cuadratico en el numero de listas
+        (stemming, comodines y consultas con varios "or").
+        Los artid de todas las listas se recorren una vez para meterlos en un conjunto, que
+        luego se ordena; como los artid son enteros pequeños el conjunto los recorre casi en
+        orden y la ordenacion es practicamente lineal.
+
+        param:  "postings": lista de posting lists (o de arrays de artid)
+
+        return: posting list nueva con los artid incluidos en alguna de las listas
+
+        """
+        if self.engine == 'numpy':
+            return self.np_union_posting(postings)
+        bitmaps = [p for p in postings if isinstance(p, SAR_Bitmap)]
+        postings = [getattr(p, 'artids', p) for p in postings if not isinstance(p, SAR_Bitmap)]
+        postings = [p for p in postings if len(p)]
+        if bitmaps or sum(map(len, postings)) * self.BITMAP_RATIO > self.artid:
+            # resultado denso: se marcan todas las listas en un solo mapa de bits
+            bits = SAR_Bitmap.from_artids(chain(*postings), self.artid).bits
+            for bitmap in bitmaps:
+                bits |= bitmap.bits
+            return SAR_Bitmap(bits, self.artid)
+        if len(postings) <= 1:
+            return SAR_Posting(postings[0] if postings else ())
+        artids = set(postings[0])
+        for p in postings[1:]:
+            artids.update(p)
+        return SAR_Posting(sorted(artids))
+
+
     def minus_posting(self, p1, p2):
         """
         OPCIONAL PARA TODAS LAS VERSIONES
@@ -864,30 +3009,132 @@ class SAR_Indexer:
         Calcula el except de dos posting list de forma EFICIENTE.
         Esta funcion se incluye por si es util, no es necesario utilizarla.
 
+        Si p2 es mucho mas larga que p1 (GALLOP_RATIO), cada artid de p1 se busca en p2 con
+        busqueda binaria. Si es p1 la mucho mas larga, cada artid de p2 se busca en p1 y se
+        copian de golpe los tramos de p1 entre ellos (asi se resuelve self.reverse_posting()).
+
         param:  "p1", "p2": posting lists sobre las que calcular
 
 
         return: posting list con los artid incluidos de p1 y no en p2
 
         """
+        if self.engine == 'numpy':
+            return self.np_minus_posting(p1, p2)
+        if isinstance(p1, SAR_Bitmap) or (self.dense(p1) and self.dense(p2)):
+            return SAR_Bitmap(self.to_bitmap(p1).bits & ~self.to_bitmap(p2).bits, self.artid)
+        if isinstance(p2, SAR_Bitmap):
+            return SAR_Posting(filterfalse(p2.flags().__getitem__, getattr(p1, 'artids', p1)))
+        respost = array('I')
+        p1 = getattr(p1, 'artids', p1); p2 = getattr(p2, 'artids', p2)
+        len1 = len(p1); len2 = len(p2)
+        if len2 > self.GALLOP_RATIO * len1:
+            k = 0
+            for artid in p1:
+                k = bisect.bisect_left(p2, artid, k)
+                if k == len2 or p2[k] != artid:
+                    respost.append(artid)
+            return SAR_Posting(respost)
+        if len1 > self.GALLOP_RATIO * len2:
+            start = 0
+            for artid in p2:
+                k = bisect.bisect_left(p1, artid, start)
+                respost.extend(p1[start:k])
+                start = k + 1 if k < len1 and p1[k] == artid else k
+            respost.extend(p1[start:])
+            return SAR_Posting(respost)
         iP1 = 0; iP2 = 0
-        while iP1 < len(p1) and iP2 < len(p2):
+        while iP1 < len1:
             dataP1 = p1[iP1]
-            dataP2 = p2[iP2]
-            if dataP1[0] == dataP2[0]:
-                p1.pop(iP1)
-                iP2 += 1
-            elif dataP1[0] > dataP2[0]:
-                iP1 += 1
-            else:
+            # avanzamos en p2 hasta el primer artid que no sea menor que dataP1
+            while iP2 < len2 and p2[iP2] < dataP1:
                 iP2 += 1
-        return p1
+            if iP2 >= len2 or p2[iP2] != dataP1:
+                respost.append(dataP1)
+            iP1 += 1
+        return SAR_Posting(respost)
 
         ########################################################
         ## COMPLETAR PARA TODAS LAS VERSIONES SI ES NECESARIO ##
         ########################################################
 
 
+    def to_numpy(self, p):
+        """
+        Devuelve una posting list como array de NumPy ordenado de artid. Las de los indices
+        no se copian, el array de NumPy comparte la memoria del array('I').
+        """
+        if isinstance(p, np.ndarray):
+            return p
+        artids = getattr(p, 'artids', p)
+        if isinstance(artids, array):
+            return np.frombuffer(artids, dtype=np.uintc)
+        return np.asarray(artids, dtype=np.uintc)
+
+
+    def np_contains(self, p1, p2):
+        """
+        Devuelve la mascara de los artid de "p1" que estan en "p2" (arrays de NumPy ordenados),
+        buscando todos a la vez con busqueda binaria en "p2".
+        """
+        if len(p2) == 0:
+            return np.zeros(len(p1), dtype=bool)
+        pos = np.searchsorted(p2, p1)
+        pos[pos == len(p2)] = 0
+        return p2[pos] == p1
+
+
+    def np_and_posting(self, p1, p2):
+        """
+        AND de dos posting lists con el motor 'numpy': los artid de la mas corta que estan en la larga.
+        """
+        p1 = self.to_numpy(p1); p2 = self.to_numpy(p2)
+        if len(p1) > len(p2):
+            p1, p2 = p2, p1
+        return p1[self.np_contains(p1, p2)]
+
+
+    def np_minus_posting(self, p1, p2):
+        """
+        Diferencia de dos posting lists con el motor 'numpy'.
+        """
+        p1 = self.to_numpy(p1)
+        return p1[~self.np_contains(p1, self.to_numpy(p2))]
+
+
+    def np_or_posting(self, p1, p2):
+        """
+        OR de dos posting lists con el motor 'numpy'.
+        """
+        return self.np_union_posting([p1, p2])
+
+
+    def np_union_posting(self, postings:List):
+        """
+        OR de varias posting lists con el motor 'numpy': se ordenan todas juntas y se quitan los
+        repetidos comparando cada artid con el anterior (np.unique es mas lento, no sabe que
+        las listas no tienen repetidos).
+        """
+        postings = [self.to_numpy(p) for p in postings]
+        if not postings:
+            return np.zeros(0, dtype=np.uintc)
+        artids = np.concatenate(postings)
+        artids.sort()
+        keep = np.empty(len(artids), dtype=bool)
+        keep[:1] = True
+        np.not_equal(artids[1:], artids[:-1], out=keep[1:])
+        return artids[keep]
+
+
+    def np_reverse_posting(self, p):
+        """
+        Complementario de una posting list con el motor 'numpy', con una mascara de todos los articulos.
+        """
+        mask = np.ones(self.artid, dtype=bool)
+        mask[self.to_numpy(p)] = False
+        return np.flatnonzero(mask).astype(np.uintc)
+
+
 
 
 
@@ -942,9 +3189,7 @@ class SAR_Indexer:
         """
 
         resultado = self.solve_query(query)
-        valores_distintos_docid = set(resultado['docid'])
-        cantidad_valores_distintos_docid = len(valores_distintos_docid)
-        print(query, "  ", cantidad_valores_distintos_docid)
+        print(query, "  ", len(resultado))
         #print("Ha salido:", len(resultado), "veces")
 
         